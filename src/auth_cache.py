@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import cache
+from typing import Union
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from . import models
+
+
+@cache
+def jwt_settings():
+    return os.getenv("SECRET_KEY"), os.getenv("ALGORITHM")
+
+
+class PrincipalCache:
+    # tokens: digest of an already verified token -> (username, exp)
+    # users: username -> (column values, cached until)
+    # user rows are evicted by the mapper events below whenever they change
+
+    def __init__(self, max_tokens: int = None, user_ttl: float = None):
+        self.max_tokens = max_tokens or int(
+            os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000")
+        )
+        self.user_ttl = (
+            user_ttl
+            if user_ttl is not None
+            else float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+        )
+        self.lock = threading.Lock()
+        self.tokens: OrderedDict[str, tuple] = OrderedDict()
+        self.users: dict[str, tuple] = {}
+
+    def _digest(self, token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def token_username(self, token: str) -> Union[str, None]:
+        key = self._digest(token)
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return None
+            username, exp = entry
+            if exp <= time.time():
+                del self.tokens[key]
+                return None
+            self.tokens.move_to_end(key)
+            return username
+
+    def put_token(self, token: str, username: str, exp: float):
+        with self.lock:
+            self.tokens[self._digest(token)] = (username, exp)
+            while len(self.tokens) > self.max_tokens:
+                self.tokens.popitem(last=False)
+
+    def get_user(self, username: str) -> Union[models.User, None]:
+        with self.lock:
+            entry = self.users.get(username)
+            if entry is None:
+                return None
+            values, until = entry
+            if until <= time.monotonic():
+                del self.users[username]
+                return None
+        # a fresh detached instance per request, sessions can attach it
+        # without loading it again
+        user = models.User(**values)
+        make_transient_to_detached(user)
+        return user
+
+    def put_user(self, user: models.User):
+        with self.lock:
+            self.users[user.username] = (
+                user.model_dump(),
+                time.monotonic() + self.user_ttl,
+            )
+
+    def invalidate_user(self, user_id: int):
+        with self.lock:
+            for username, (values, _) in list(self.users.items()):
+                if values["id"] == user_id:
+                    del self.users[username]
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+            self.users.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _evict_user(mapper, connection, target):
+    principal_cache.invalidate_user(target.id)
@@ -1,13 +1,17 @@
 from datetime import datetime, timedelta, timezone
 from typing import Union
 
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from src.util import verify_password
-from .crud import get_user_email
+from src.util import (
+    get_password_hash_async,
+    password_needs_rehash,
+    verify_password_async,
+)
+from .auth_cache import jwt_settings
+from .crud import get_user_email_async
 
 import jwt
-import os
 
 
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
@@ -17,16 +21,20 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        to_encode, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM")
-    )
+    secret_key, algorithm = jwt_settings()
+    encoded_jwt = jwt.encode(to_encode, secret_key, algorithm=algorithm)
     return encoded_jwt
 
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user_email(db, email)
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_email_async(db, email)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await verify_password_async(password, user.password):
         return False
+    if password_needs_rehash(user.password):
+        # the cost factor changed since this hash was made
+        user.password = await get_password_hash_async(password)
+        db.add(user)
+        await db.commit()
     return user
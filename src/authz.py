@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+from fastapi import HTTPException
+from sqlalchemy import event, false, literal, union_all
+from sqlalchemy.orm import Session as OrmSession, object_session
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import models
+
+
+@dataclass(frozen=True)
+class Permissions:
+    # what one user may touch, resolved in a single query and checked in memory
+    user_id: int
+    # projects the user is linked to, plus the projects of their organizations
+    project_ids: frozenset = field(default_factory=frozenset)
+    # personal projects of the user, the only ones they may edit
+    owned_project_ids: frozenset = field(default_factory=frozenset)
+    org_ids: frozenset = field(default_factory=frozenset)
+    managed_org_ids: frozenset = field(default_factory=frozenset)
+
+    def require_project(self, project_id: int):
+        if project_id not in self.project_ids:
+            raise HTTPException(
+                status_code=400, detail="User does not have access to the project"
+            )
+
+    def require_owned_project(self, project_id: int):
+        if project_id not in self.owned_project_ids:
+            raise HTTPException(
+                status_code=400, detail="User does not have access to the project"
+            )
+
+    def require_org(self, org_id: int):
+        if org_id not in self.org_ids:
+            raise HTTPException(
+                status_code=400, detail="User does not have access to the organization"
+            )
+
+    def require_org_manager(self, org_id: int):
+        if org_id not in self.managed_org_ids:
+            raise HTTPException(
+                status_code=400, detail="User is not a manager of the organization"
+            )
+
+
+def permissions_select(user_id: int):
+    # (kind, id, manager) rows for everything the user can reach
+    return union_all(
+        select(literal("project"), models.UserProject.project_id, false()).where(
+            models.UserProject.user_id == user_id
+        ),
+        select(literal("owned"), models.Project.id, false())
+        .where(models.Project.owner_id == user_id)
+        .where(models.Project.owner_is_org == False),
+        select(
+            literal("org"),
+            models.UserOrganization.organization_id,
+            models.UserOrganization.manager,
+        ).where(models.UserOrganization.user_id == user_id),
+        select(literal("project"), models.Project.id, false())
+        .join(
+            models.UserOrganization,
+            models.UserOrganization.organization_id == models.Project.owner_id,
+        )
+        .where(models.Project.owner_is_org == True)
+        .where(models.UserOrganization.user_id == user_id),
+    )
+
+
+def permissions_from_rows(user_id: int, rows) -> Permissions:
+    ids = {"project": set(), "owned": set(), "org": set(), "managed": set()}
+    for kind, id, manager in rows:
+        if id is None:
+            continue
+        ids[kind].add(id)
+        if kind == "org" and manager:
+            ids["managed"].add(id)
+    return Permissions(
+        user_id=user_id,
+        project_ids=frozenset(ids["project"] | ids["owned"]),
+        owned_project_ids=frozenset(ids["owned"]),
+        org_ids=frozenset(ids["org"]),
+        managed_org_ids=frozenset(ids["managed"]),
+    )
+
+
+class AccessCache:
+    # user id -> (Permissions, cached until)
+    # membership changes made through the ORM evict the users they concern
+    # (events below), the ttl bounds staleness of changes made elsewhere
+
+    def __init__(self, ttl: float = None):
+        self.ttl = (
+            ttl if ttl is not None else float(os.getenv("AUTHZ_CACHE_TTL", "30"))
+        )
+        self.lock = threading.Lock()
+        self.entries: dict[int, tuple] = {}
+
+    def get(self, user_id: int) -> Permissions | None:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            permissions, until = entry
+            if until <= time.monotonic():
+                del self.entries[user_id]
+                return None
+            return permissions
+
+    def put(self, permissions: Permissions):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[permissions.user_id] = (
+                permissions,
+                time.monotonic() + self.ttl,
+            )
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+access_cache = AccessCache()
+
+
+def load_permissions(db: Session, user_id: int) -> Permissions:
+    permissions = access_cache.get(user_id)
+    if permissions is None:
+        rows = db.exec(permissions_select(user_id)).all()
+        permissions = permissions_from_rows(user_id, rows)
+        access_cache.put(permissions)
+    return permissions
+
+
+async def load_permissions_async(db: AsyncSession, user_id: int) -> Permissions:
+    permissions = access_cache.get(user_id)
+    if permissions is None:
+        rows = (await db.exec(permissions_select(user_id))).all()
+        permissions = permissions_from_rows(user_id, rows)
+        access_cache.put(permissions)
+    return permissions
+
+
+def _evict(target, user_id):
+    # evict now and once more after the commit, so a request reading in
+    # between cannot keep the old memberships cached
+    if user_id is None:
+        access_cache.clear()
+    else:
+        access_cache.invalidate(user_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("authz_evict", set()).add(user_id)
+
+
+@event.listens_for(models.UserProject, "after_insert")
+@event.listens_for(models.UserProject, "after_update")
+@event.listens_for(models.UserProject, "after_delete")
+@event.listens_for(models.UserOrganization, "after_insert")
+@event.listens_for(models.UserOrganization, "after_update")
+@event.listens_for(models.UserOrganization, "after_delete")
+def _evict_member(mapper, connection, target):
+    _evict(target, target.user_id)
+
+
+@event.listens_for(models.Project, "after_insert")
+@event.listens_for(models.Project, "after_update")
+@event.listens_for(models.Project, "after_delete")
+def _evict_project(mapper, connection, target):
+    # members of an organization are not known here, drop everything then
+    _evict(target, None if target.owner_is_org else target.owner_id)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _evict_committed(session):
+    user_ids = session.info.pop("authz_evict", None)
+    if not user_ids:
+        return
+    if None in user_ids:
+        access_cache.clear()
+        return
+    for user_id in user_ids:
+        access_cache.invalidate(user_id)
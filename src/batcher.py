@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from .llm import LLMBackend
+
+
+class RequestAbandoned(RuntimeError):
+    pass
+
+
+class RequestBatcher:
+    # sits between process_nodes and the backends:
+    # - identical requests that are in flight at the same time share one call
+    # - complete() requests arriving within `window` seconds of each other are
+    #   sent to the backend together through complete_batch()
+    # - when the caller generating an answer is cancelled, whoever joined it
+    #   starts a call of their own
+    # only runs with "stream": false call complete(), and only backends that
+    # override complete_batch() gain from the window, the fallback still
+    # makes one call per request
+
+    def __init__(self, window: float = None, max_batch_size: int = None):
+        self.window = (
+            window
+            if window is not None
+            else float(os.getenv("LLM_BATCH_WINDOW_MS", "5")) / 1000
+        )
+        self.max_batch_size = max_batch_size or int(
+            os.getenv("LLM_MAX_BATCH_SIZE", "16")
+        )
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.pending: Dict[str, List[Tuple[asyncio.Future, List[dict]]]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.tasks = set()
+
+    def request_key(self, backend: LLMBackend, messages: List[dict]) -> str:
+        payload = json.dumps([backend.settings(), messages], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _new_future(self, key: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if not future.cancelled():
+            # mark the exception as retrieved even if nobody else waited for it
+            future.exception()
+
+    def _joinable(self, key: str):
+        future = self.in_flight.get(key)
+        return future if future is not None and not future.done() else None
+
+    async def complete(self, backend: LLMBackend, messages: List[dict]) -> str:
+        key = self.request_key(backend, messages)
+        while True:
+            future = self._joinable(key)
+            if future is None:
+                future = self._new_future(key)
+                batch = self.pending.setdefault(backend.name, [])
+                batch.append((future, messages))
+                if len(batch) >= self.max_batch_size:
+                    self._flush(backend)
+                elif len(batch) == 1:
+                    loop = asyncio.get_running_loop()
+                    self.timers[backend.name] = loop.call_later(
+                        self.window, self._flush, backend
+                    )
+            try:
+                return await asyncio.shield(future)
+            except RequestAbandoned:
+                continue
+
+    def _flush(self, backend: LLMBackend):
+        timer = self.timers.pop(backend.name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(backend.name, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._run_batch(backend, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, backend: LLMBackend, batch):
+        try:
+            results = await backend.complete_batch([messages for _, messages in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def stream(self, backend: LLMBackend, messages: List[dict]):
+        key = self.request_key(backend, messages)
+        while (future := self._joinable(key)) is not None:
+            # someone is already generating this exact answer, wait for the
+            # whole text instead of starting a second generation
+            try:
+                text = await asyncio.shield(future)
+            except RequestAbandoned:
+                continue
+            yield text
+            return
+
+        future = self._new_future(key)
+        chunks = []
+        try:
+            async for chunk in backend.stream(messages):
+                chunks.append(chunk)
+                yield chunk
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(
+                    e if isinstance(e, Exception) else RequestAbandoned()
+                )
+            raise
+        future.set_result("".join(chunks))
+
+
+batcher = RequestBatcher()
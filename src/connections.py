@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from .ws_codec import JSONCodec, negotiate
+
+logger = logging.getLogger(__name__)
+
+
+def ws_queue_size():
+    return int(os.getenv("WS_QUEUE_SIZE", "256"))
+
+
+def ws_ping_interval():
+    return float(os.getenv("WS_PING_INTERVAL", "20"))
+
+
+def ws_idle_timeout():
+    # opt-in, 0 leaves dead peers to the protocol level pings of the server
+    # (uvicorn --ws-ping-interval/--ws-ping-timeout)
+    return float(os.getenv("WS_IDLE_TIMEOUT", "0"))
+
+
+def message_node(message: dict):
+    if message.get("type") in ("update_node", "update_node_delta"):
+        return message["data"]["id"]
+    return None
+
+
+class Connection:
+    # one websocket with its own outbound queue and writer task, so a run
+    # only waits for a slow client once the queue is full of messages that
+    # can't be merged
+    # - update_node replaces everything still queued for the same node
+    # - update_node_delta is appended to a queued delta of the same node
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue: int = None,
+        ping_interval: float = None,
+        idle_timeout: float = None,
+        codec=None,
+    ):
+        self.websocket = websocket
+        self.codec = codec or JSONCodec()
+        self.max_queue = max_queue or ws_queue_size()
+        self.ping_interval = (
+            ping_interval if ping_interval is not None else ws_ping_interval()
+        )
+        self.idle_timeout = (
+            idle_timeout if idle_timeout is not None else ws_idle_timeout()
+        )
+        self.queue: deque = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.closed = False
+        self.last_received = time.monotonic()
+        # set by the first pong, clients that never answer aren't timed out
+        self.answers_pings = False
+        self.sent = 0
+        self.merged = 0
+        self.peak = 0
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._write())]
+        if self.ping_interval > 0 and self.idle_timeout > 0:
+            self.tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def receive(self) -> dict:
+        # raises ValueError for frames the codec can't read, or that don't
+        # hold an object
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        data = message.get("text")
+        if data is None:
+            data = message.get("bytes")
+        if not data:
+            return None
+        message = self.codec.decode(data)
+        if not isinstance(message, dict):
+            raise ValueError(f"Expected an object, got {type(message).__name__}")
+        return message
+
+    async def send(self, message: dict):
+        # a closed connection swallows messages, the run still gets persisted
+        while not self.closed:
+            if len(self.queue) >= self.max_queue and self._absorb(message):
+                self.merged += 1
+                return
+            if len(self.queue) < self.max_queue:
+                self.queue.append(message)
+                self.peak = max(self.peak, len(self.queue))
+                self.ready.set()
+                return
+            self.space.clear()
+            await self.space.wait()
+
+    def _absorb(self, message: dict) -> bool:
+        # on a full queue: True when the message was folded into a queued one,
+        # otherwise drops whatever the message supersedes
+        node_id = message_node(message)
+        if node_id is None:
+            return False
+
+        if message["type"] == "update_node":
+            kept = deque(x for x in self.queue if message_node(x) != node_id)
+            self.merged += len(self.queue) - len(kept)
+            self.queue = kept
+            return False
+
+        for queued in reversed(self.queue):
+            if message_node(queued) != node_id:
+                continue
+            if queued["type"] != "update_node_delta":
+                return False
+            queued["data"] = {
+                "id": node_id,
+                "delta": queued["data"]["delta"] + message["data"]["delta"],
+            }
+            return True
+        return False
+
+    async def _write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    message = self.queue.popleft()
+                    self.space.set()
+                    data = self.codec.encode(message)
+                    if self.codec.binary:
+                        await self.websocket.send_bytes(data)
+                    else:
+                        await self.websocket.send_text(data)
+                    self.sent += 1
+                self.ready.clear()
+        except Exception as e:
+            logger.info(f"Websocket writer stopped: {e}")
+            self._mark_closed()
+
+    async def _heartbeat(self):
+        while not self.closed:
+            await asyncio.sleep(self.ping_interval)
+            idle = time.monotonic() - self.last_received
+            if self.answers_pings and idle > self.idle_timeout:
+                logger.info(f"Closing websocket idle for {idle:.0f}s")
+                self._mark_closed()
+                try:
+                    await self.websocket.close(code=1001)
+                except Exception:
+                    pass
+                return
+            await self.send({"type": "ping"})
+
+    def received(self, message: dict) -> bool:
+        # True when the message was connection housekeeping
+        self.last_received = time.monotonic()
+        if message.get("type") == "ping":
+            self.queue.append({"type": "pong"})
+            self.ready.set()
+            return True
+        if message.get("type") == "pong":
+            self.answers_pings = True
+            return True
+        return False
+
+    def _mark_closed(self):
+        self.closed = True
+        self.space.set()
+
+    async def close(self):
+        self._mark_closed()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "peak": self.peak,
+            "max_queue": self.max_queue,
+            "sent": self.sent,
+            "merged": self.merged,
+            "closed": self.closed,
+            "codec": self.codec.name,
+        }
+
+
+class ConnectionManager:
+    def __init__(self):
+        self.connections: Dict[int, Connection] = {}
+
+    async def connect(self, websocket: WebSocket) -> Connection:
+        codec, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, codec=codec)
+        connection.start()
+        self.connections[id(connection)] = connection
+        logger.info(f"Number of active connections: {len(self.connections)}")
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        self.connections.pop(id(connection), None)
+        await connection.close()
+        logger.info(f"Number of active connections: {len(self.connections)}")
+
+    def stats(self) -> list[dict]:
+        return [x.stats() for x in self.connections.values()]
+
+    def __len__(self):
+        return len(self.connections)
+
+
+manager = ConnectionManager()
@@ -1,37 +1,176 @@
+import json
 import os
+from datetime import datetime, timedelta
 from typing import Annotated
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, WebSocket, WebSocketException, status
 import jwt
 
+from sqlalchemy import and_, case, delete, func, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.util import get_password_hash
 from . import models
-from .util import get_db, oauth2_scheme
+from .pagination import Page
+from .timing import phase
+from .snapshots import (
+    decode_snapshot,
+    decode_snapshot_bytes,
+    delta_enabled,
+    encode_snapshot,
+    max_delta_depth,
+    snapshot_bytes,
+    snapshot_hash,
+)
+from .auth_cache import jwt_settings, principal_cache
+from .authz import Permissions, load_permissions_async
+from .util import get_async_db, oauth2_scheme
 from .exceptions import credentials_exception
 
 
+DIAGRAM_SUMMARY_FIELDS = (
+    "id",
+    "title",
+    "description",
+    "project_id",
+    "created_at",
+    "updated_at",
+)
+DIAGRAM_EXTRA_FIELDS = ("config",)
+PROJECT_SUMMARY_FIELDS = (
+    "id",
+    "name",
+    "description",
+    "status_code",
+    "owner_id",
+    "owner_is_org",
+    "updated_at",
+)
+PROJECT_EXTRA_FIELDS = ("created_at",)
+RECENT_DIAGRAMS_SHOWN = 5
+
+
+def recent_diagrams_keep():
+    return max(int(os.getenv("RECENT_DIAGRAMS_KEEP", "20")), RECENT_DIAGRAMS_SHOWN)
+
+
+def summary_columns(model, summary: tuple, extra: tuple, fields: list[str] | None):
+    fields = fields or []
+    unknown = set(fields) - set(summary) - set(extra)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return [getattr(model, x) for x in summary + extra if x in summary or x in fields]
+
+
+def diagram_summary_select(fields: list[str] | None):
+    # only the legacy rows without a blob need to look at the inline image
+    has_image = case(
+        (models.Diagram.thumbnail_key.is_not(None), True),
+        else_=func.coalesce(func.length(models.Diagram.image), 0) > 0,
+    )
+    return select(
+        *summary_columns(
+            models.Diagram, DIAGRAM_SUMMARY_FIELDS, DIAGRAM_EXTRA_FIELDS, fields
+        ),
+        models.Diagram.thumbnail_key,
+        has_image.label("has_image"),
+    )
+
+
+def diagram_summaries(rows):
+    result = []
+    for row in rows:
+        data = dict(row._mapping)
+        thumbnail_key = data.pop("thumbnail_key")
+        has_image = data.pop("has_image")
+        data["thumbnail_url"] = models.thumbnail_url(
+            data["id"], thumbnail_key, has_image
+        )
+        result.append(data)
+    return result
+
+
+def project_summary_select(fields: list[str] | None):
+    return select(
+        *summary_columns(
+            models.Project, PROJECT_SUMMARY_FIELDS, PROJECT_EXTRA_FIELDS, fields
+        )
+    )
+
+
+def project_summaries(rows):
+    return [dict(row._mapping) for row in rows]
+
+
 async def get_current_user(
-    token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: AsyncSession = Depends(get_async_db),
 ) -> models.User:
-    try:
-        payload = jwt.decode(
-            token, os.getenv("SECRET_KEY"), algorithms=[os.getenv("ALGORITHM")]
-        )
-        username: str = payload.get("sub")
+    with phase("auth"):
+        return await _current_user(token, db)
+
+
+async def _current_user(token: str, db: AsyncSession) -> models.User:
+    username = principal_cache.token_username(token)
+    if username is None:
+        secret_key, algorithm = jwt_settings()
+        try:
+            payload = jwt.decode(token, secret_key, algorithms=[algorithm])
+            username: str = payload.get("sub")
+
+            if username is None:
+                raise credentials_exception
+            token_data = models.TokenData(username=username)
 
-        if username is None:
+        except jwt.InvalidTokenError:
             raise credentials_exception
-        token_data = models.TokenData(username=username)
+        username = token_data.username
+        principal_cache.put_token(token, username, payload.get("exp", 0))
 
-    except jwt.InvalidTokenError:
-        raise credentials_exception
-    user = get_user_username(db, username=token_data.username)
+    user = principal_cache.get_user(username)
+    if user is not None:
+        return user
+
+    user = await get_user_username_async(db, username=username)
     if user is None:
         raise credentials_exception
+    # handlers attach the user to their own (sync) session
+    db.expunge(user)
+    principal_cache.put_user(user)
     return user
 
 
+async def get_websocket_user(
+    websocket: WebSocket, db: AsyncSession = Depends(get_async_db)
+) -> models.User:
+    # browsers can't set headers on a websocket, ?token= works as well
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer ") :]
+    if not token:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION)
+    try:
+        return await _current_user(token, db)
+    except HTTPException:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION)
+    finally:
+        # the socket lives on, don't hold a pooled connection for it
+        await db.close()
+
+
+async def get_permissions(
+    current_user: Annotated[models.User, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db),
+) -> Permissions:
+    # cached per user, the data queries check against it in memory
+    with phase("auth"):
+        return await load_permissions_async(db, current_user.id)
+
+
 async def get_current_active_user(
     current_user: Annotated[models.User, Depends(get_current_user)],
 ):
@@ -69,46 +208,111 @@ def create_user_project(db: Session, project: models.Project, user_id: int):
 
 
 def create_diagram_in_project(
-    db: Session, diagram: models.Diagram, project_id: int, user_id: int
+    db: Session, diagram: models.Diagram, project_id: int, permissions: Permissions
 ):
-    db_diagram = models.Diagram(**diagram.model_dump(), owner_id=project_id)
+    # the project in the path wins over whatever the body says
+    permissions.require_project(project_id)
+    db_diagram = models.Diagram(
+        **diagram.model_dump(exclude={"project_id"}), project_id=project_id
+    )
     db.add(db_diagram)
     db.commit()
+
+    touch_last_used_diagrams(
+        db, {(permissions.user_id, db_diagram.id): datetime.now()}
+    )
     db.refresh(db_diagram)
+    return db_diagram
+
 
-    db_last_diagram = models.LastUsedDiagram(diagram_id=db_diagram.id, user_id=user_id)
-    db.add(db_last_diagram)
+def touch_last_used_diagrams(
+    db: Session, touches: dict[tuple[int, int], datetime], keep: int | None = None
+):
+    # touches - (user_id, diagram_id) -> time of the open
+    # one row per user and diagram, each user keeps only the newest ones
+    if not touches:
+        return
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(models.LastUsedDiagram).values(
+        [
+            {
+                "user_id": user_id,
+                "diagram_id": diagram_id,
+                "created_at": at,
+                "updated_at": at,
+            }
+            for (user_id, diagram_id), at in touches.items()
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "diagram_id"],
+        set_={"updated_at": statement.excluded.updated_at},
+    )
+    db.execute(statement)
+    for user_id in {x for x, _ in touches}:
+        prune_last_used_diagrams(db, user_id, keep or recent_diagrams_keep())
     db.commit()
-    db.refresh(db_last_diagram)
-    return db_diagram
 
 
-def get_last_diagrams(db: Session, user_id):
-    try:
-        data = db.exec(
-            select(models.Diagram)
-            .where(models.Diagram.id == models.LastUsedDiagram.diagram_id)
-            .where(models.LastUsedDiagram.user_id == user_id)
-            .order_by(models.LastUsedDiagram.updated_at.desc())
-            .limit(5)
-        ).all()
-        for x in data:
-            print(x.title)
-        return data
-    except Exception:
-        print("Error")
-
-
-def get_projects_by_user(db: Session, id: int):
-    return db.exec(
-        select(models.Project)
+def prune_last_used_diagrams(db: Session, user_id: int, keep: int):
+    newest = (
+        select(models.LastUsedDiagram.id)
+        .where(models.LastUsedDiagram.user_id == user_id)
+        .order_by(
+            models.LastUsedDiagram.updated_at.desc(), models.LastUsedDiagram.id.desc()
+        )
+        .limit(keep)
+    )
+    db.execute(
+        delete(models.LastUsedDiagram)
+        .where(models.LastUsedDiagram.user_id == user_id)
+        .where(models.LastUsedDiagram.id.not_in(newest))
+    )
+
+
+def recent_diagrams_select(statement, user_id: int):
+    # walks ix_lastuseddiagram_user_id_updated_at backwards, newest first
+    return (
+        statement.join(
+            models.LastUsedDiagram,
+            models.LastUsedDiagram.diagram_id == models.Diagram.id,
+        )
+        .where(models.LastUsedDiagram.user_id == user_id)
+        .order_by(models.LastUsedDiagram.updated_at.desc())
+        .limit(RECENT_DIAGRAMS_SHOWN)
+    )
+
+
+async def get_last_diagrams_async(
+    db: AsyncSession, user_id: int, fields: list[str] | None = None
+):
+    rows = (
+        await db.exec(recent_diagrams_select(diagram_summary_select(fields), user_id))
+    ).all()
+    return diagram_summaries(rows)
+
+
+def get_projects_by_user(
+    db: Session,
+    id: int,
+    fields: list[str] | None = None,
+    page: Page | None = None,
+):
+    statement = (
+        project_summary_select(fields)
         .join(models.UserProject)
         .where(models.UserProject.user_id == id)
-    ).all()
+    )
+    if page is not None:
+        statement = page.apply(statement, models.Project)
+    return project_summaries(db.exec(statement).all())
 
 
-def get_users(db: Session):
-    return db.exec(select(models.User)).all()
+def get_users(db: Session, page: Page | None = None):
+    statement = select(models.User)
+    if page is not None:
+        statement = page.apply(statement, models.User)
+    return db.exec(statement).all()
 
 
 def get_user_id(db: Session, id: int):
@@ -123,123 +327,131 @@ def get_user_username(db: Session, username: str):
     return db.exec(select(models.User).where(models.User.username == username)).first()
 
 
-def get_diagrams_in_project(db: Session, id: int, user_id: int):
-    access = db.exec(
-        select(models.UserProject).where(models.UserProject.user_id == user_id)
+async def get_user_email_async(db: AsyncSession, email: str):
+    return (
+        await db.exec(select(models.User).where(models.User.email == email))
     ).first()
 
-    if access is None:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the project"
-        )
 
-    return db.exec(select(models.Diagram).where(models.Diagram.project_id == id)).all()
+async def get_user_username_async(db: AsyncSession, username: str):
+    return (
+        await db.exec(select(models.User).where(models.User.username == username))
+    ).first()
 
 
-def get_diagram_by_id(db: Session, id: int, user_id: int):
-    st = db.exec(select(models.Diagram).where(models.Diagram.id == id))
-    diagram = st.all()[0]
+def get_diagrams_in_project(
+    db: Session,
+    id: int,
+    permissions: Permissions,
+    fields: list[str] | None = None,
+    page: Page | None = None,
+):
+    permissions.require_project(id)
 
-    access = db.exec(
-        select(models.UserProject).where(
-            models.UserProject.user_id == user_id,
-            models.UserProject.project_id == diagram.project_id,
-        )
-    ).first()
-    if access is None:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the project"
-        )
+    statement = diagram_summary_select(fields).where(models.Diagram.project_id == id)
+    if page is not None:
+        statement = page.apply(statement, models.Diagram)
+    return diagram_summaries(db.exec(statement).all())
 
-    if (
-        db.exec(
-            select(models.LastUsedDiagram).order_by(
-                models.LastUsedDiagram.updated_at.desc()
-            )
-        )
-        .first()
-        .diagram_id
-        != id
-    ):
-        db_last_diagram = models.LastUsedDiagram(diagram_id=diagram.id, user_id=user_id)
-        db.add(db_last_diagram)
-        db.commit()
-        db.refresh(db_last_diagram)
 
-    # print("We did it diagram:", diagram, st)
+async def get_diagram_by_id_async(
+    db: AsyncSession, id: int, permissions: Permissions
+):
+    diagram = (
+        await db.exec(select(models.Diagram).where(models.Diagram.id == id))
+    ).first()
+    if diagram is None:
+        raise HTTPException(404, "Not found")
+    permissions.require_project(diagram.project_id)
+
+    # the open is recorded by the caller, see src/recent_diagrams.py
     return diagram
 
 
-def update_diagram_config(
-    db: Session, diagram_id: int, diagram_config: str, diagram_image: str, user_id: int
+async def update_diagram_config_async(
+    db: AsyncSession,
+    diagram_id: int,
+    diagram_config: str,
+    diagram_image: str | None,
+    permissions: Permissions,
 ):
-    diagram: models.Diagram = db.exec(
-        select(models.Diagram).where(models.Diagram.id == diagram_id)
+    diagram = (
+        await db.exec(select(models.Diagram).where(models.Diagram.id == diagram_id))
     ).first()
-    if diagram == None:
+    if diagram is None:
         raise HTTPException(404, "Not found")
-
-    project: models.Project = db.exec(
-        select(models.Project).where(models.Project.id == diagram.project_id)
-    ).first()
-    access = not project.owner_is_org and project.owner_id == user_id
-    if not access:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the project"
-        )
+    permissions.require_owned_project(diagram.project_id)
 
     diagram.config = diagram_config
-    diagram.image = diagram_image
+    if diagram_image is not None:
+        diagram.image = diagram_image
     db.add(diagram)
-    db.commit()
-    db.refresh(diagram)
+    await db.commit()
+    await db.refresh(diagram)
 
     return diagram
 
 
-def get_project_by_id(db: Session, id: int, user_id: int):
-    access = db.exec(
-        select(models.UserProject).where(models.UserProject.user_id == user_id)
+def update_diagram_thumbnail(
+    db: Session, diagram_id: int, thumbnail_key: str, image_hash: str
+):
+    diagram = db.exec(
+        select(models.Diagram).where(models.Diagram.id == diagram_id)
     ).first()
+    if diagram is None:
+        return None
 
-    if access is None:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the project"
-        )
-
-    return db.exec(select(models.Project).where(models.Project.id == id)).first()
+    diagram.thumbnail_key = thumbnail_key
+    diagram.image_hash = image_hash
+    # the inline copy from before the blob store is not needed anymore
+    diagram.image = ""
+    db.add(diagram)
+    db.commit()
+    return diagram
 
 
-def get_projects_by_organization(db: Session, org_id: int, user_id: int):
-    access = db.exec(
-        select(models.UserOrganization).where(
-            models.UserOrganization.user_id == user_id
+async def get_diagram_thumbnail_async(
+    db: AsyncSession, id: int, permissions: Permissions
+):
+    return (
+        await db.exec(
+            select(
+                models.Diagram.thumbnail_key,
+                models.Diagram.image,
+                models.Diagram.image_hash,
+            )
+            .where(models.Diagram.id == id)
+            .where(models.Diagram.project_id.in_(permissions.project_ids))
         )
     ).first()
 
-    if access is None:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the organization"
-        )
 
-    return db.exec(
-        select(models.Project)
+def get_project_by_id(db: Session, id: int, permissions: Permissions):
+    permissions.require_project(id)
+    return db.exec(select(models.Project).where(models.Project.id == id)).first()
+
+
+def get_projects_by_organization(
+    db: Session,
+    org_id: int,
+    permissions: Permissions,
+    fields: list[str] | None = None,
+    page: Page | None = None,
+):
+    permissions.require_org(org_id)
+
+    statement = (
+        project_summary_select(fields)
         .where(models.Project.owner_id == org_id)
         .where(models.Project.owner_is_org == True)
-    ).all()
-
+    )
+    if page is not None:
+        statement = page.apply(statement, models.Project)
+    return project_summaries(db.exec(statement).all())
 
-def get_organization_by_id(db: Session, user_id: int, org_id: int):
-    access = db.exec(
-        select(models.UserOrganization).where(
-            models.UserOrganization.user_id == user_id
-        )
-    ).first()
 
-    if access is None:
-        raise HTTPException(
-            status_code=400, detail="User does not have access to the organization"
-        )
+def get_organization_by_id(db: Session, permissions: Permissions, org_id: int):
+    permissions.require_org(org_id)
 
     db_org = db.exec(
         select(models.Organization).where(models.Organization.id == org_id)
@@ -261,23 +473,9 @@ def create_organization(db: Session, org: models.Organization, user: models.User
 
 
 def create_project_in_organization(
-    db: Session, org_id: str, proj: models.Project, user
+    db: Session, org_id: int, proj: models.Project, permissions: Permissions
 ):
-
-    is_manager = (
-        db.exec(
-            select(models.UserOrganization).where(
-                models.UserOrganization.user_id == user.id
-            )
-        )
-        .first()
-        .manager
-    )
-
-    if not is_manager:
-        raise HTTPException(
-            status_code=400, detail="User is not a manager of the organization"
-        )
+    permissions.require_org_manager(org_id)
 
     db_project = models.Project(
         owner_id=org_id, owner_is_org=True, **proj.model_dump(exclude={"owner_is_org"})
@@ -296,10 +494,243 @@ def create_generated_conted(db: Session, content: models.GeneratedContent):
     db.refresh(content)
 
 
-def create_executed_config(db: Session, diagram_id: int, config: str):
-    config = models.ExecutedDiagramConfig(diagram_id=diagram_id, config=config)
-    db.add(config)
+def create_generated_contents(db: Session, contents: list[models.GeneratedContent]):
+    db.add_all(contents)
     db.commit()
-    db.refresh(config)
 
-    return config
+
+def create_executed_config(
+    db: Session,
+    diagram_id: int,
+    config: str,
+    graph: str | None = None,
+    run_settings: str | None = None,
+):
+    content_hash = snapshot_hash(config, graph)
+    existing = db.exec(
+        select(models.ExecutedDiagramConfig)
+        .where(models.ExecutedDiagramConfig.diagram_id == diagram_id)
+        .where(models.ExecutedDiagramConfig.content_hash == content_hash)
+        .where(models.ExecutedDiagramConfig.run_settings == run_settings)
+        .order_by(models.ExecutedDiagramConfig.id.desc())
+        .limit(1)
+    ).first()
+    if existing is not None:
+        # same snapshot as an earlier run, bump it so it counts as the last one
+        existing.updated_at = datetime.now()
+        db.add(existing)
+        db.commit()
+        db.refresh(existing)
+        return existing
+
+    base = None
+    if delta_enabled():
+        base = get_last_executed_config(db, diagram_id)
+        if base is not None and base.delta_depth >= max_delta_depth():
+            base = None
+
+    encoding, payload = encode_snapshot(
+        config,
+        graph,
+        executed_config_bytes(db, base) if base is not None else None,
+    )
+    executed_config = models.ExecutedDiagramConfig(
+        diagram_id=diagram_id,
+        content_hash=content_hash,
+        encoding=encoding,
+        payload=payload,
+        base_id=base.id if base is not None else None,
+        delta_depth=base.delta_depth + 1 if base is not None else 0,
+        run_settings=run_settings,
+    )
+    db.add(executed_config)
+    db.commit()
+    db.refresh(executed_config)
+
+    return executed_config
+
+
+def executed_config_bytes(db: Session, executed_config: models.ExecutedDiagramConfig):
+    if executed_config.encoding == "raw":
+        return snapshot_bytes(executed_config.config, executed_config.graph)
+    base = None
+    if executed_config.base_id is not None:
+        base = executed_config_bytes(
+            db, db.get(models.ExecutedDiagramConfig, executed_config.base_id)
+        )
+    return decode_snapshot_bytes(
+        executed_config.encoding, executed_config.payload, base
+    )
+
+
+def read_executed_config(db: Session, executed_config: models.ExecutedDiagramConfig):
+    # (config, graph) of a run, whatever way the row is stored
+    if executed_config.encoding == "raw":
+        return executed_config.config, executed_config.graph
+    return decode_snapshot(executed_config_bytes(db, executed_config))
+
+
+def get_last_executed_config(db: Session, diagram_id: int):
+    return db.exec(
+        select(models.ExecutedDiagramConfig)
+        .where(models.ExecutedDiagramConfig.diagram_id == diagram_id)
+        .order_by(
+            models.ExecutedDiagramConfig.updated_at.desc(),
+            models.ExecutedDiagramConfig.id.desc(),
+        )
+        .limit(1)
+    ).first()
+
+
+def get_generated_contents(db: Session, diagram_id: int, config_id: int):
+    return db.exec(
+        select(models.GeneratedContent)
+        .where(models.GeneratedContent.diagram_id == diagram_id)
+        .where(models.GeneratedContent.config_id == config_id)
+        .order_by(models.GeneratedContent.id)
+    ).all()
+
+
+def enqueue_run_job(db: Session, diagram_id: int, user_id: int, request: str):
+    job = models.RunJob(diagram_id=diagram_id, user_id=user_id, request=request)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_run_job(db: Session, public_id: str):
+    return db.exec(
+        select(models.RunJob).where(models.RunJob.public_id == public_id)
+    ).first()
+
+
+def claimable_run_jobs(now: datetime):
+    # queued, or running on a worker that stopped renewing its lease
+    return or_(
+        models.RunJob.status == "queued",
+        and_(models.RunJob.status == "running", models.RunJob.lease_until < now),
+    )
+
+
+def claim_run_job(db: Session, worker: str, lease_seconds: float, max_attempts: int):
+    # compare-and-set on status and attempts, so workers in any number of
+    # processes can claim from the same table and each job goes to one of them
+    now = datetime.now()
+    candidates = db.exec(
+        select(
+            models.RunJob.id,
+            models.RunJob.public_id,
+            models.RunJob.status,
+            models.RunJob.attempts,
+        )
+        .where(claimable_run_jobs(now))
+        .order_by(models.RunJob.id)
+        .limit(8)
+    ).all()
+    # end the read, every claim below is a write transaction of its own
+    db.commit()
+
+    for id, public_id, status, attempts in candidates:
+        if attempts >= max_attempts:
+            values = {"status": "failed", "error": "worker lost", "lease_until": None}
+        else:
+            values = {
+                "status": "running",
+                "worker": worker,
+                "lease_until": now + timedelta(seconds=lease_seconds),
+                "attempts": attempts + 1,
+            }
+        result = db.execute(
+            update(models.RunJob)
+            .where(models.RunJob.id == id)
+            .where(models.RunJob.status == status)
+            .where(models.RunJob.attempts == attempts)
+            .values(**values)
+        )
+        if result.rowcount != 1:
+            db.rollback()
+            continue
+        if values["status"] == "failed":
+            add_run_event(
+                db,
+                id,
+                {
+                    "type": "run_status",
+                    "data": {
+                        "run_id": public_id,
+                        "status": "failed",
+                        "error": "worker lost",
+                    },
+                },
+            )
+            continue
+        db.commit()
+        return db.get(models.RunJob, id)
+    return None
+
+
+def renew_run_job(db: Session, id: int, worker: str, lease_seconds: float) -> bool:
+    result = db.execute(
+        update(models.RunJob)
+        .where(models.RunJob.id == id)
+        .where(models.RunJob.worker == worker)
+        .where(models.RunJob.status == "running")
+        .values(lease_until=datetime.now() + timedelta(seconds=lease_seconds))
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def finish_run_job(
+    db: Session, id: int, worker: str, status: str, error: str | None = None
+) -> bool:
+    # status "queued" hands the job back for another worker to pick up
+    result = db.execute(
+        update(models.RunJob)
+        .where(models.RunJob.id == id)
+        .where(models.RunJob.worker == worker)
+        .where(models.RunJob.status == "running")
+        .values(status=status, error=error, lease_until=None)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def add_run_event(db: Session, run_id: int, message: dict) -> int:
+    event = models.RunEvent(run_id=run_id, message=json.dumps(message))
+    db.add(event)
+    db.commit()
+    return event.id
+
+
+def get_run_events(db: Session, run_id: int, after: int = 0, limit: int = 500):
+    return db.exec(
+        select(models.RunEvent.id, models.RunEvent.message)
+        .where(models.RunEvent.run_id == run_id)
+        .where(models.RunEvent.id > after)
+        .order_by(models.RunEvent.id)
+        .limit(limit)
+    ).all()
+
+
+def prune_run_jobs(db: Session, before: datetime) -> int:
+    # finished runs and their events, once nobody is expected to follow them
+    finished = (
+        select(models.RunJob.id)
+        .where(models.RunJob.status.in_(("done", "failed")))
+        .where(models.RunJob.updated_at < before)
+    )
+    db.execute(delete(models.RunEvent).where(models.RunEvent.run_id.in_(finished)))
+    result = db.execute(delete(models.RunJob).where(models.RunJob.id.in_(finished)))
+    db.commit()
+    return result.rowcount
+
+
+def require_diagram_access(db: Session, diagram_id: int, permissions: Permissions):
+    project_id = db.exec(
+        select(models.Diagram.project_id).where(models.Diagram.id == diagram_id)
+    ).first()
+    if project_id is None:
+        raise HTTPException(404, "Not found")
+    permissions.require_project(project_id)
@@ -1,7 +1,69 @@
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+# the engine is built at import time, before main gets to load the .env file
+load_dotenv()
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
+
+
+def async_database_url(url: str) -> str:
+    # same database through an asyncio driver
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://") :]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://") :]
+    return url
+
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    options = {"pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1"}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+        if ":memory:" in url or url.rstrip("/").endswith(":"):
+            return options
+        if is_async:
+            # aiosqlite defaults to NullPool, which would reconnect (and rerun
+            # the pragmas) for every session
+            options["poolclass"] = AsyncAdaptedQueuePool
+    options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "10"))
+    options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    options["pool_recycle"] = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run next to the single writer, NORMAL only fsyncs at
+    # checkpoints, busy_timeout makes writers wait for the lock instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cache_size = int(os.getenv("SQLITE_CACHE_SIZE", "-64000"))
+    mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", "268435456"))
+    busy_timeout = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+    cursor.execute(f"PRAGMA cache_size={cache_size}")
+    cursor.execute(f"PRAGMA mmap_size={mmap_size}")
+    cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+    cursor.close()
+
+
+def configure_engine(engine):
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+engine = configure_engine(
+    create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
+)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+async_engine = create_async_engine(
+    async_database_url(SQLALCHEMY_DATABASE_URL),
+    **engine_options(SQLALCHEMY_DATABASE_URL, is_async=True),
 )
+configure_engine(async_engine.sync_engine)
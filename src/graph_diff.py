@@ -0,0 +1,44 @@
+from typing import Dict, Iterable, List, Set
+
+
+def node_signature(node: dict):
+    # pointedBy order matters, it decides which "{}" gets which upstream output
+    return (
+        node.get("nodeType"),
+        node.get("data", {}).get("text"),
+        tuple(node.get("pointedBy", [])),
+    )
+
+
+def downstream(nodes: List[dict], roots: Iterable[str]) -> Set[str]:
+    dependents: Dict[str, List[str]] = {}
+    for node in nodes:
+        for dep in node.get("pointedBy", []):
+            dependents.setdefault(dep, []).append(node["id"])
+
+    seen = set()
+    stack = list(roots)
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen:
+            continue
+        seen.add(node_id)
+        stack.extend(dependents.get(node_id, []))
+    return seen
+
+
+def dirty_nodes(
+    previous_nodes: List[dict], current_nodes: List[dict], stored_ids: Set[str]
+) -> Set[str]:
+    # a node is dirty when it is new, its type/text/edges changed, it is a
+    # generate node without a stored result, or anything upstream is dirty
+    previous = {node["id"]: node_signature(node) for node in previous_nodes}
+
+    changed = set()
+    for node in current_nodes:
+        if previous.get(node["id"]) != node_signature(node):
+            changed.add(node["id"])
+        elif node.get("nodeType") == "generate" and node["id"] not in stored_ids:
+            changed.add(node["id"])
+
+    return downstream(current_nodes, changed)
@@ -0,0 +1,479 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Union
+
+from . import crud, models
+from .util import get_db
+
+logger = logging.getLogger(__name__)
+
+# diagram runs as jobs on a durable queue, for authenticated sockets only
+#   client -> server  {"type": "run", "diagram_id", "data": [...], ...}
+#   server -> client  {"type": "run_queued", "data": {"run_id"}}
+#                     progress as before, each message tagged with "run_id"
+#                     and, when stored, "event_id"
+#                     {"type": "run_status", "data": {"run_id", "status", "error"}}
+#   client -> server  {"type": "subscribe", "data": {"run_id", "after"}}
+#                     replays stored events after event id `after`, then
+#                     follows the run, e.g. after a reconnect
+# a run keeps going when its socket goes away, only the user who started it
+# can follow it
+
+
+def job_workers():
+    return int(os.getenv("JOB_WORKERS", "4"))
+
+
+def job_lease_seconds():
+    return float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+
+def job_max_attempts():
+    return int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+
+def job_poll_interval():
+    return float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+
+def job_retention_hours():
+    return float(os.getenv("JOB_RETENTION_HOURS", "24"))
+
+
+def job_executor_enabled():
+    # 0 when only dedicated worker processes (python -m src.jobs) run jobs
+    return os.getenv("JOB_EXECUTOR", "1") == "1"
+
+
+def run_status(run_id: str, status: str, error: Union[str, None] = None):
+    return {
+        "type": "run_status",
+        "data": {"run_id": run_id, "status": status, "error": error},
+    }
+
+
+class JobBroker:
+    # where runs wait for a worker and where their progress is kept
+    # - a job goes queued -> running -> done | failed, claim() hands each job
+    #   to one worker, finish() with "queued" hands it back
+    # - events are the stored progress of a run, in publish order
+
+    lease_seconds = 60.0
+
+    def enqueue(self, diagram_id: int, user_id: int, request: dict) -> str:
+        # the public id of the run
+        raise NotImplementedError
+
+    def get(self, public_id: str) -> Union[models.RunJob, None]:
+        raise NotImplementedError
+
+    def claim(self, worker: str) -> Union[models.RunJob, None]:
+        raise NotImplementedError
+
+    def renew(self, run_id: int, worker: str) -> bool:
+        raise NotImplementedError
+
+    def finish(
+        self, run_id: int, worker: str, status: str, error: Union[str, None] = None
+    ) -> bool:
+        raise NotImplementedError
+
+    def publish(self, run_id: int, message: dict) -> int:
+        raise NotImplementedError
+
+    def events(self, run_id: int, after: int = 0) -> list[tuple[int, dict]]:
+        raise NotImplementedError
+
+    def prune(self, before: datetime) -> int:
+        # drops finished runs last touched before `before`
+        raise NotImplementedError
+
+
+class DatabaseBroker(JobBroker):
+    # the runjob and runevent tables of the app database, sqlite by default
+
+    def __init__(
+        self,
+        get_db: Callable = get_db,
+        lease_seconds: float = None,
+        max_attempts: int = None,
+    ):
+        self.get_db = get_db
+        self.lease_seconds = lease_seconds or job_lease_seconds()
+        self.max_attempts = max_attempts or job_max_attempts()
+
+    def _run(self, fn, *args):
+        db_gen = self.get_db()
+        db = next(db_gen)
+        try:
+            return fn(db, *args)
+        finally:
+            db_gen.close()
+
+    def enqueue(self, diagram_id, user_id, request):
+        job = self._run(
+            crud.enqueue_run_job, diagram_id, user_id, json.dumps(request)
+        )
+        return job.public_id
+
+    def get(self, public_id):
+        return self._run(crud.get_run_job, public_id)
+
+    def claim(self, worker):
+        return self._run(
+            crud.claim_run_job, worker, self.lease_seconds, self.max_attempts
+        )
+
+    def renew(self, run_id, worker):
+        return self._run(crud.renew_run_job, run_id, worker, self.lease_seconds)
+
+    def finish(self, run_id, worker, status, error=None):
+        return self._run(crud.finish_run_job, run_id, worker, status, error)
+
+    def publish(self, run_id, message):
+        return self._run(crud.add_run_event, run_id, message)
+
+    def events(self, run_id, after=0):
+        rows = self._run(crud.get_run_events, run_id, after)
+        return [(id, json.loads(message)) for id, message in rows]
+
+    def prune(self, before):
+        return self._run(crud.prune_run_jobs, before)
+
+
+brokers: Dict[str, Callable[[], JobBroker]] = {"database": DatabaseBroker}
+_broker: Union[JobBroker, None] = None
+
+
+def register_broker(name: str, factory: Callable[[], JobBroker]):
+    brokers[name] = factory
+
+
+def get_broker() -> JobBroker:
+    # created lazily, .env is loaded after the routers are imported
+    global _broker
+    if _broker is None:
+        _broker = brokers[os.getenv("JOB_BROKER", "database")]()
+    return _broker
+
+
+class RunHub:
+    # hands progress of runs executing in this process to the sockets
+    # following them, publishers and followers may sit on different loops
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # run id -> {follower queue: the loop the follower runs on}
+        self.listeners: Dict[int, dict] = {}
+
+    def subscribe(self, run_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.listeners.setdefault(run_id, {})[queue] = loop
+        return queue
+
+    def unsubscribe(self, run_id: int, queue: asyncio.Queue):
+        with self.lock:
+            listeners = self.listeners.get(run_id, {})
+            listeners.pop(queue, None)
+            if not listeners:
+                self.listeners.pop(run_id, None)
+
+    def publish(self, run_id: int, event_id: Union[int, None], message: dict):
+        with self.lock:
+            listeners = list(self.listeners.get(run_id, {}).items())
+        for queue, loop in listeners:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (event_id, message))
+            except RuntimeError:
+                # the follower's loop is gone
+                pass
+
+
+run_hub = RunHub()
+
+
+class RunPublisher:
+    # stands in for the socket in process_nodes
+    # token deltas only go to live followers, everything else is stored first
+    # so a client subscribing later can replay it
+    # nodes run concurrently, stored events reach the hub in id order only
+    # because one is stored and handed over at a time
+
+    def __init__(self, run_id: int, broker: JobBroker, hub: RunHub):
+        self.run_id = run_id
+        self.broker = broker
+        self.hub = hub
+        self.lock = asyncio.Lock()
+
+    async def send(self, message: dict):
+        if message.get("type") == "update_node_delta":
+            self.hub.publish(self.run_id, None, message)
+            return
+        async with self.lock:
+            event_id = await asyncio.to_thread(
+                self.broker.publish, self.run_id, message
+            )
+            self.hub.publish(self.run_id, event_id, message)
+
+
+class RunExecutor:
+    # claims jobs from the broker and runs them as tasks on the loop it was
+    # started on, the server's or that of a worker process
+    # - up to `workers` runs at a time; more cores take more processes, each
+    #   started with python -m src.jobs and claiming from the same broker
+    # - the lease of a running job is renewed, a job whose worker died is
+    #   claimed again once the lease runs out, a run that lost its lease is
+    #   cancelled here
+    # - on shutdown unfinished jobs go back to the queue
+    # - finished runs are pruned after JOB_RETENTION_HOURS
+
+    def __init__(
+        self,
+        broker: JobBroker = None,
+        hub: RunHub = None,
+        workers: int = None,
+        poll_interval: float = None,
+    ):
+        self._broker = broker
+        self.hub = hub or run_hub
+        self.workers = workers or job_workers()
+        self.poll_interval = (
+            poll_interval if poll_interval is not None else job_poll_interval()
+        )
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.task: Union[asyncio.Task, None] = None
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.wake: Union[asyncio.Event, None] = None
+        self.stopped: Union[asyncio.Event, None] = None
+
+    @property
+    def broker(self) -> JobBroker:
+        return self._broker or get_broker()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def notify(self):
+        # a job was enqueued, don't wait for the next poll
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def stop(self):
+        # from any thread, run() returns once the workers are cancelled
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def shutdown(self):
+        task, self.task = self.task, None
+        if task is not None:
+            self.stop()
+            await task
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.stopped = asyncio.Event()
+        tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self._prune()))
+        try:
+            await self.stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop = None
+
+    async def _work(self):
+        while True:
+            self.wake.clear()
+            try:
+                job = await asyncio.to_thread(self.broker.claim, self.name)
+            except Exception:
+                logger.exception("Could not claim a job")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the job is claimed again once its lease runs out
+                logger.exception(f"Could not execute run {job.id}")
+
+    async def _prune(self):
+        retention = timedelta(hours=job_retention_hours())
+        while True:
+            try:
+                before = datetime.now() - retention
+                pruned = await asyncio.to_thread(self.broker.prune, before)
+                if pruned:
+                    logger.info(f"Pruned {pruned} finished runs")
+            except Exception:
+                logger.exception("Could not prune finished runs")
+            await asyncio.sleep(min(retention.total_seconds(), 3600))
+
+    async def _renew(self, run_id: int, run: asyncio.Task):
+        lease_seconds = self.broker.lease_seconds
+        interval = lease_seconds / 3
+        expires = time.monotonic() + lease_seconds
+        while True:
+            await asyncio.sleep(interval)
+            attempted = time.monotonic()
+            try:
+                renewed = await asyncio.to_thread(self.broker.renew, run_id, self.name)
+            except Exception:
+                logger.exception(f"Could not renew the lease on run {run_id}")
+                # try again while the lease still holds until the next attempt
+                if time.monotonic() + interval < expires:
+                    continue
+                renewed = False
+            if not renewed:
+                # someone else claims it, it must not run twice
+                logger.warning(f"Lost the lease on run {run_id}, stopping it")
+                run.cancel()
+                return
+            expires = attempted + lease_seconds
+
+    async def execute(self, job: models.RunJob):
+        # the router imports this module
+        from .routers.graph_processor import process_nodes
+
+        broker = self.broker
+        publisher = RunPublisher(job.id, broker, self.hub)
+        run = asyncio.create_task(process_nodes(json.loads(job.request), publisher))
+        lease = asyncio.create_task(self._renew(job.id, run))
+        status, error = "done", None
+        try:
+            await run
+        except asyncio.CancelledError:
+            if lease.done() and not lease.cancelled():
+                return
+            # shutting down, hand the job back
+            run.cancel()
+            try:
+                await asyncio.to_thread(broker.finish, job.id, self.name, "queued")
+            except Exception:
+                logger.exception(f"Could not hand run {job.id} back")
+            raise
+        except Exception as e:
+            logger.exception(f"Run {job.id} failed")
+            status, error = "failed", str(e)
+            await publisher.send({"type": "run_error", "data": {"text": error}})
+        finally:
+            lease.cancel()
+        try:
+            if await asyncio.to_thread(
+                broker.finish, job.id, self.name, status, error
+            ):
+                await publisher.send(run_status(job.public_id, status, error))
+        except Exception:
+            # the lease runs out and the job is claimed again
+            logger.exception(f"Could not finish run {job.id}")
+
+
+run_executor = RunExecutor()
+
+
+async def enqueue_run(request: dict, user_id: int) -> str:
+    # the caller checked that the user may run the diagram
+    public_id = await asyncio.to_thread(
+        get_broker().enqueue, request["diagram_id"], user_id, request
+    )
+    run_executor.notify()
+    return public_id
+
+
+def tagged(message: dict, run_id: str, event_id: Union[int, None] = None):
+    message = {**message, "run_id": run_id}
+    if event_id is not None:
+        message["event_id"] = event_id
+    return message
+
+
+async def follow_run(
+    connection,
+    job: models.RunJob,
+    after: int = 0,
+    broker: JobBroker = None,
+    hub: RunHub = None,
+    poll_interval: float = None,
+):
+    # forwards the progress of a run to a connection until the run is over
+    # stored events come from the broker, deltas of runs in this process come
+    # live through the hub; runs on other processes are polled for
+    broker = broker or get_broker()
+    hub = hub or run_hub
+    if poll_interval is None:
+        poll_interval = job_poll_interval()
+    queue = hub.subscribe(job.id)
+    last = after
+    try:
+        while True:
+            # stored events: all of them at first, later whatever was stored
+            # elsewhere or got past the hub
+            for event_id, message in await asyncio.to_thread(
+                broker.events, job.id, last
+            ):
+                last = event_id
+                await connection.send(tagged(message, job.public_id, event_id))
+                if message["type"] == "run_status":
+                    return
+            # live messages in publish order, the db again once they stop
+            try:
+                while True:
+                    event_id, message = await asyncio.wait_for(
+                        queue.get(), poll_interval
+                    )
+                    if event_id is not None:
+                        if event_id <= last:
+                            continue
+                        last = event_id
+                    await connection.send(tagged(message, job.public_id, event_id))
+                    if message["type"] == "run_status":
+                        return
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        hub.unsubscribe(job.id, queue)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    executor = RunExecutor()
+    logger.info(f"Worker {executor.name} running {executor.workers} jobs at a time")
+
+    async def work():
+        from .llm import close_http_client
+
+        try:
+            await executor.run()
+        finally:
+            await close_http_client()
+
+    try:
+        asyncio.run(work())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # a worker process without the web server, start one per core
+    main()
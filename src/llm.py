@@ -0,0 +1,177 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Dict, List, Union
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+_http_client: Union[httpx.AsyncClient, None] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # one pool for the whole process, so nodes reuse keep-alive connections
+    # instead of paying a new TCP/TLS handshake per request
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100")),
+                max_keepalive_connections=int(
+                    os.getenv("LLM_POOL_MAX_KEEPALIVE", "20")
+                ),
+                keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60")),
+            ),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class LLMBackend:
+    name: str
+
+    def settings(self) -> dict:
+        return {"backend": self.name}
+
+    def stream(self, messages: List[dict]) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def complete(self, messages: List[dict]) -> str:
+        return "".join([chunk async for chunk in self.stream(messages)])
+
+    async def complete_batch(self, batch: List[List[dict]]) -> list:
+        # backends that accept several conversations in one call override this,
+        # the fallback fans out over the pool; failures are returned, not raised
+        return await asyncio.gather(
+            *[self.complete(messages) for messages in batch], return_exceptions=True
+        )
+
+
+class EchoBackend(LLMBackend):
+    # stand-in model: echoes the last message back a few characters at a time
+
+    def __init__(self, name="echo", chunk_size=None):
+        self.name = name
+        self.chunk_size = chunk_size
+
+    async def stream(self, messages):
+        text = messages[-1]["content"]
+        chunk_size = self.chunk_size or int(os.getenv("LLM_STUB_CHUNK_SIZE", "16"))
+        for i in range(0, len(text), chunk_size):
+            await asyncio.sleep(0)
+            yield text[i : i + chunk_size]
+
+    async def complete_batch(self, batch):
+        await asyncio.sleep(0)
+        return [messages[-1]["content"] for messages in batch]
+
+
+class ChatCompletionBackend(LLMBackend):
+    # any server speaking the OpenAI /v1/chat/completions protocol
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        model: Union[str, None] = None,
+        api_key: Union[str, None] = None,
+        timeout: float = 60.0,
+        max_concurrency: int = 8,
+        client: Union[httpx.AsyncClient, None] = None,
+    ):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 10.0))
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = client
+
+    def settings(self):
+        return {"backend": self.name, "url": self.url, "model": self.model}
+
+    def _client(self):
+        return self.client or get_http_client()
+
+    def _request(self, messages, stream):
+        body = {"messages": messages, "stream": stream}
+        if self.model:
+            body["model"] = self.model
+        headers = {}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return {"json": body, "headers": headers, "timeout": self.timeout}
+
+    async def complete(self, messages):
+        async with self.semaphore:
+            response = await self._client().post(
+                self.url, **self._request(messages, False)
+            )
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def stream(self, messages):
+        async with self.semaphore:
+            async with self._client().stream(
+                "POST", self.url, **self._request(messages, True)
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:") :].strip()
+                    if data == "[DONE]":
+                        break
+                    delta = json.loads(data)["choices"][0].get("delta", {})
+                    if delta.get("content"):
+                        yield delta["content"]
+
+
+backends: Dict[str, LLMBackend] = {}
+_configured = False
+
+
+def register_backend(backend: LLMBackend):
+    backends[backend.name] = backend
+
+
+def configure_backends():
+    global _configured
+    _configured = True
+    register_backend(EchoBackend())
+    if os.getenv("LLM_BACKEND_URL"):
+        register_backend(
+            ChatCompletionBackend(
+                "openai",
+                os.getenv("LLM_BACKEND_URL"),
+                model=os.getenv("LLM_MODEL"),
+                api_key=os.getenv("LLM_API_KEY"),
+                timeout=float(os.getenv("LLM_TIMEOUT", "60")),
+                max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+            )
+        )
+
+
+def get_backend(name: Union[str, None] = None) -> LLMBackend:
+    # configured lazily, .env is loaded after the routers are imported
+    if not _configured:
+        configure_backends()
+    if name is None:
+        name = os.getenv("LLM_BACKEND") or (
+            "openai" if "openai" in backends else "echo"
+        )
+    return backends[name]
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# protocol with the browser in "local" mode
+#   server -> client  {"type": "run_local", "data": {"request_id", "url", "data"}}
+#   client -> server  {"type": "local_llm", "request_id", "data": <answer>}
+#                     {"type": "local_conn_error", "request_id", "data": ...}
+# any number of run_local requests can be in flight, replies come back in
+# whatever order the client finishes them
+
+
+class LocalLLMError(Exception):
+    # the client could not answer, args[0] is the reply type
+    pass
+
+
+def local_llm_timeout():
+    return float(os.getenv("LOCAL_LLM_TIMEOUT", "300"))
+
+
+class LocalLLMDispatcher:
+    # routes replies read from one socket to the requests waiting for them
+    # socket - anything with send(message), see src/connections.py
+    # the socket's reader loop hands every message to dispatch()
+
+    def __init__(self, socket, timeout: float = None):
+        self.socket = socket
+        self.timeout = timeout if timeout is not None else local_llm_timeout()
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def request(self, url: str, node_id: str, messages: list) -> str:
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.socket.send(
+                {
+                    "type": "run_local",
+                    "data": {
+                        "request_id": request_id,
+                        "url": url,
+                        "data": {"id": node_id, "messages": messages},
+                    },
+                }
+            )
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise LocalLLMError("local_llm_timeout")
+        finally:
+            self.pending.pop(request_id, None)
+
+    def dispatch(self, message: dict) -> bool:
+        # True when the message was a reply to one of our requests
+        if message.get("type") not in ("local_llm", "local_conn_error"):
+            return False
+        request_id = message.get("request_id")
+        if request_id is None and len(self.pending) == 1:
+            # clients from before request ids answer one request at a time
+            request_id = next(iter(self.pending))
+        future = self.pending.get(request_id)
+        if future is None or future.done():
+            logger.info(f"Dropping reply to unknown local request {request_id}")
+            return True
+        if message["type"] == "local_llm":
+            future.set_result(message["data"])
+        else:
+            future.set_exception(LocalLLMError(message["type"]))
+        return True
+
+    def fail_all(self, error: Exception):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
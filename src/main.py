@@ -1,12 +1,11 @@
 from dotenv import load_dotenv
 from typing import Annotated
-from fastapi import Depends, FastAPI, Request, WebSocket
+from fastapi import Depends, FastAPI, WebSocket
 import sentry_sdk
-import time
 
 from contextlib import asynccontextmanager
 from fastapi.responses import HTMLResponse, JSONResponse
-from sqlmodel import SQLModel, Session, select
+from sqlmodel import Session, select
 
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
@@ -23,8 +22,15 @@ from .routers import project
 from .routers import organizations
 from .routers import diagram
 from .routers import recent
+from .routers import metrics
 from . import models
 from .database import engine
+from .migrations import migrate
+from .jobs import job_executor_enabled, run_executor
+from .llm import close_http_client
+from .recent_diagrams import recent_diagrams
+from .thumbnails import thumbnail_pipeline
+from .timing import TimedJSONResponse, TimingMiddleware
 
 load_dotenv()
 
@@ -38,7 +44,7 @@ load_dotenv()
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    migrate(engine)
     if len(Session(engine).exec(select(models.ProjectStatusCode)).all()) == 3:
         return
     with Session(engine) as session:
@@ -52,23 +58,17 @@ def create_db_and_tables():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    if job_executor_enabled():
+        run_executor.start()
     yield
+    await run_executor.shutdown()
+    await close_http_client()
+    thumbnail_pipeline.shutdown()
+    recent_diagrams.shutdown()
 
 
-app = FastAPI(lifespan=lifespan)
-
-
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    body = await request.body()
-    # if (request.method == "POST" or request.method == "PUT") and len(body) < 1000:
-        # print(f"Request body: {body}")
-    # print(body.decode("utf-8"))
-    start_time = time.perf_counter()
-    response = await call_next(request)
-    process_time = time.perf_counter() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    return response
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
+app.add_middleware(TimingMiddleware)
 
 
 app.include_router(graph_processor.router)
@@ -78,6 +78,7 @@ app.include_router(project.router)
 app.include_router(organizations.router)
 app.include_router(diagram.router)
 app.include_router(recent.router)
+app.include_router(metrics.router)
 
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
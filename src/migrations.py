@@ -0,0 +1,389 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    literal,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+
+from .crud import recent_diagrams_keep
+
+logger = logging.getLogger(__name__)
+
+# kept apart from SQLModel.metadata so drop_all/create_all never touch it
+schema_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# every migration spells out its own schema, nothing here may follow the
+# models: a change to models.py needs a new migration, and
+# test_migrations checks that the migrated schema matches the models
+
+
+def _timestamps():
+    return [
+        Column("created_at", DateTime, nullable=False),
+        Column("updated_at", DateTime, nullable=False),
+    ]
+
+
+def baseline_metadata():
+    # the schema as it was when migrations were introduced
+    metadata = MetaData()
+    Table(
+        "user",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("email", String, nullable=False),
+        Column("username", String, nullable=False),
+        Column("password", String, nullable=False),
+        Column("is_active", Boolean, nullable=False, default=True),
+        *_timestamps(),
+        Index("ix_user_email", "email", unique=True),
+        Index("ix_user_username", "username", unique=True),
+    )
+    Table(
+        "organization",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, nullable=False),
+        Column("description", String, nullable=False),
+        Column("owner_id", Integer, ForeignKey("user.id"), nullable=False),
+        *_timestamps(),
+    )
+    Table(
+        "projectstatuscode",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("status", String, nullable=False, default="In Progress"),
+        *_timestamps(),
+    )
+    Table(
+        "project",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, nullable=False),
+        Column("description", String, nullable=False),
+        Column(
+            "status_code",
+            Integer,
+            ForeignKey("projectstatuscode.id"),
+            nullable=False,
+            default=1,
+        ),
+        Column("owner_id", Integer, ForeignKey("organization.id"), nullable=False),
+        Column("owner_is_org", Boolean, nullable=False, default=False),
+        *_timestamps(),
+    )
+    Table(
+        "userproject",
+        metadata,
+        Column("manager", Boolean, nullable=False, default=False),
+        Column("user_id", Integer, ForeignKey("user.id"), primary_key=True),
+        Column("project_id", Integer, ForeignKey("project.id"), primary_key=True),
+        *_timestamps(),
+    )
+    Table(
+        "userorganization",
+        metadata,
+        Column("manager", Boolean, nullable=False, default=False),
+        Column("user_id", Integer, ForeignKey("user.id"), primary_key=True),
+        Column("organization_id", Integer, ForeignKey("organization.id")),
+        *_timestamps(),
+    )
+    Table(
+        "diagrams",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("title", String, nullable=False),
+        Column("description", String, nullable=False),
+        Column("config", String, default=""),
+        Column("image", String, default=""),
+        Column("image_hash", String),
+        Column("thumbnail_key", String),
+        Column("project_id", Integer, ForeignKey("project.id"), nullable=False),
+        *_timestamps(),
+    )
+    Table(
+        "lastuseddiagram",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("diagram_id", Integer, ForeignKey("diagrams.id"), nullable=False),
+        Column("user_id", Integer, ForeignKey("user.id"), nullable=False),
+        *_timestamps(),
+    )
+    Table(
+        "nodetype",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("type", String, nullable=False),
+        *_timestamps(),
+    )
+    Table(
+        "executeddiagramconfig",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("diagram_id", Integer, ForeignKey("diagrams.id"), nullable=False),
+        Column("config", String, nullable=False, default=""),
+        Column("graph", String),
+        Column("content_hash", String),
+        Column("encoding", String, nullable=False, default="raw"),
+        Column("payload", LargeBinary),
+        Column("base_id", Integer, ForeignKey("executeddiagramconfig.id")),
+        Column("delta_depth", Integer, nullable=False, default=0),
+        *_timestamps(),
+    )
+    Table(
+        "generatedcontent",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("diagram_id", Integer, ForeignKey("diagrams.id"), nullable=False),
+        Column("type_id", Integer, ForeignKey("nodetype.id"), nullable=False),
+        Column(
+            "config_id",
+            Integer,
+            ForeignKey("executeddiagramconfig.id"),
+            nullable=False,
+        ),
+        Column("content", String, nullable=False),
+        Column("node_id", String, nullable=False),
+        Column("prompt_hash", String),
+        *_timestamps(),
+    )
+    return metadata
+
+
+def default_sql(column: Column, dialect) -> str:
+    # rendered by the dialect, postgres wants true/false for booleans
+    return str(
+        literal(column.default.arg, column.type).compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def add_missing_columns(conn: Connection, metadata: MetaData):
+    # databases made by create_all before migrations existed miss the columns
+    # added to the models since then
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in metadata.sorted_tables:
+        existing = {x["name"] for x in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(conn.dialect)
+            ddl = f"{preparer.format_column(column)} {column_type}"
+            if column.default is not None:
+                ddl += f" DEFAULT {default_sql(column, conn.dialect)}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            conn.execute(
+                text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}")
+            )
+
+
+def create_index(conn: Connection, name: str, table: str, *columns, unique=False):
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    conn.execute(
+        text(
+            f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        )
+    )
+
+
+def migration_0001_baseline(conn: Connection):
+    metadata = baseline_metadata()
+    metadata.create_all(conn)
+    add_missing_columns(conn, metadata)
+
+
+def migration_0002_tuned_indexes(conn: Connection):
+    # text search never went through these, they only slowed down writes
+    for name in (
+        "ix_diagrams_title",
+        "ix_diagrams_description",
+        "ix_executeddiagramconfig_content_hash",
+    ):
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    create_index(
+        conn,
+        "ix_lastuseddiagram_user_id_updated_at",
+        "lastuseddiagram",
+        "user_id",
+        "updated_at",
+    )
+    create_index(
+        conn,
+        "ix_diagrams_project_id_updated_at",
+        "diagrams",
+        "project_id",
+        "updated_at",
+    )
+    create_index(
+        conn,
+        "ix_project_owner_id_owner_is_org_updated_at",
+        "project",
+        "owner_id",
+        "owner_is_org",
+        "updated_at",
+    )
+    create_index(
+        conn,
+        "ix_generatedcontent_diagram_id_config_id",
+        "generatedcontent",
+        "diagram_id",
+        "config_id",
+    )
+    create_index(
+        conn, "ix_generatedcontent_prompt_hash", "generatedcontent", "prompt_hash"
+    )
+    create_index(
+        conn,
+        "ix_executeddiagramconfig_diagram_id_content_hash",
+        "executeddiagramconfig",
+        "diagram_id",
+        "content_hash",
+    )
+    create_index(
+        conn,
+        "ix_executeddiagramconfig_diagram_id_updated_at",
+        "executeddiagramconfig",
+        "diagram_id",
+        "updated_at",
+    )
+    create_index(
+        conn,
+        "ix_userorganization_organization_id",
+        "userorganization",
+        "organization_id",
+    )
+
+
+def migration_0003_recent_diagrams_upsert(conn: Connection):
+    # one row per user and diagram, the newest open wins
+    conn.execute(
+        text(
+            "DELETE FROM lastuseddiagram WHERE id NOT IN "
+            "(SELECT max(id) FROM lastuseddiagram GROUP BY user_id, diagram_id)"
+        )
+    )
+    create_index(
+        conn,
+        "ux_lastuseddiagram_user_id_diagram_id",
+        "lastuseddiagram",
+        "user_id",
+        "diagram_id",
+        unique=True,
+    )
+    conn.execute(
+        text(
+            "DELETE FROM lastuseddiagram WHERE id IN (SELECT id FROM "
+            "(SELECT id, row_number() OVER (PARTITION BY user_id "
+            "ORDER BY updated_at DESC, id DESC) AS n FROM lastuseddiagram) "
+            "AS ranked WHERE n > :keep)"
+        ),
+        {"keep": recent_diagrams_keep()},
+    )
+
+
+def migration_0004_run_jobs(conn: Connection):
+    metadata = MetaData()
+    # only there for the foreign key, never created here
+    Table("diagrams", metadata, Column("id", Integer, primary_key=True))
+    runjob = Table(
+        "runjob",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("diagram_id", Integer, ForeignKey("diagrams.id"), nullable=False),
+        Column("status", String, nullable=False),
+        Column("request", String, nullable=False),
+        Column("worker", String),
+        Column("lease_until", DateTime),
+        Column("attempts", Integer, nullable=False),
+        Column("error", String),
+        *_timestamps(),
+        Index("ix_runjob_status_id", "status", "id"),
+    )
+    runevent = Table(
+        "runevent",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("run_id", Integer, ForeignKey("runjob.id"), nullable=False),
+        Column("message", String, nullable=False),
+        *_timestamps(),
+        Index("ix_runevent_run_id_id", "run_id", "id"),
+    )
+    metadata.create_all(conn, tables=[runjob, runevent])
+
+
+def migration_0005_run_owners(conn: Connection):
+    # runs from before have neither, nobody can follow them any more
+    conn.execute(text("ALTER TABLE runjob ADD COLUMN public_id VARCHAR"))
+    conn.execute(
+        text('ALTER TABLE runjob ADD COLUMN user_id INTEGER REFERENCES "user" (id)')
+    )
+    create_index(conn, "ux_runjob_public_id", "runjob", "public_id", unique=True)
+
+
+def migration_0006_run_settings(conn: Connection):
+    # earlier runs have none, nothing is reused from them
+    conn.execute(
+        text("ALTER TABLE executeddiagramconfig ADD COLUMN run_settings VARCHAR")
+    )
+
+
+# append only, a released migration must never change
+MIGRATIONS = [
+    (1, "baseline", migration_0001_baseline),
+    (2, "tuned indexes", migration_0002_tuned_indexes),
+    (3, "recent diagrams upsert", migration_0003_recent_diagrams_upsert),
+    (4, "run jobs", migration_0004_run_jobs),
+    (5, "run owners", migration_0005_run_owners),
+    (6, "run settings", migration_0006_run_settings),
+]
+
+
+def current_version(conn: Connection):
+    return conn.execute(
+        select(schema_version.c.version).order_by(schema_version.c.version.desc())
+    ).scalar()
+
+
+def _stamp(conn: Connection, version: int, name: str):
+    conn.execute(
+        schema_version.insert().values(
+            version=version, name=name, applied_at=datetime.now()
+        )
+    )
+
+
+def migrate(engine: Engine):
+    with engine.begin() as conn:
+        schema_metadata.create_all(conn)
+        # an empty database, or one from before migrations, starts at 0
+        version = current_version(conn) or 0
+        for number, name, migration in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.warning(f"Applying migration {number:04d} {name}")
+            migration(conn)
+            _stamp(conn, number, name)
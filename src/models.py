@@ -1,5 +1,7 @@
+import uuid
 from datetime import datetime
 from typing import List, Union
+from sqlalchemy import Index
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -13,14 +15,65 @@ class RecordExtender:
 
 class Diagram(SQLModel, RecordExtender, table=True):
     __tablename__ = "diagrams"
+    __table_args__ = (
+        Index("ix_diagrams_project_id_updated_at", "project_id", "updated_at"),
+    )
     id: int | None = Field(default=None, primary_key=True)
-    title: str = Field(index=True)
-    description: str = Field(index=True)
+    title: str
+    description: str
     config: str | None = ""
     image: str | None = ""
+    image_hash: str | None = None
+    thumbnail_key: str | None = None
     project_id: int = Field(foreign_key="project.id")
 
 
+def thumbnail_url(diagram_id: int, thumbnail_key: str | None, image: str | None):
+    # the version parameter changes with the content, so clients can cache
+    # the url for good
+    if thumbnail_key:
+        return f"/diagram/{diagram_id}/thumbnail?v={thumbnail_key[:16]}"
+    if image:
+        return f"/diagram/{diagram_id}/thumbnail"
+    return None
+
+
+class DiagramRead(SQLModel, RecordExtender, table=False):
+    id: int
+    title: str
+    description: str
+    config: str | None = ""
+    project_id: int
+    thumbnail_url: str | None = None
+
+    @classmethod
+    def from_diagram(cls, diagram: Diagram):
+        return cls(
+            id=diagram.id,
+            title=diagram.title,
+            description=diagram.description,
+            config=diagram.config,
+            project_id=diagram.project_id,
+            created_at=diagram.created_at,
+            updated_at=diagram.updated_at,
+            thumbnail_url=thumbnail_url(
+                diagram.id, diagram.thumbnail_key, diagram.image
+            ),
+        )
+
+
+class DiagramSummary(SQLModel, table=False):
+    id: int
+    title: str
+    description: str
+    project_id: int
+    created_at: datetime
+    updated_at: datetime
+    thumbnail_url: str | None = None
+    # only with ?fields=config
+    config: str | None = None
+
+
 class UserProject(SQLModel, RecordExtender, table=True):
     manager: bool = Field(default=False)
     user_id: int = Field(foreign_key="user.id", primary_key=True)
@@ -30,7 +83,7 @@ class UserProject(SQLModel, RecordExtender, table=True):
 class UserOrganization(SQLModel, RecordExtender, table=True):
     manager: bool = Field(default=False)
     user_id: int = Field(foreign_key="user.id", primary_key=True)
-    organization_id: int | None = Field(foreign_key="organization.id")
+    organization_id: int | None = Field(foreign_key="organization.id", index=True)
 
     user: "User" = Relationship(back_populates="organization_link")
     organization: "Organization" = Relationship(back_populates="user_links")
@@ -51,6 +104,14 @@ class User(SQLModel, RecordExtender, table=True):
 
 
 class Project(SQLModel, RecordExtender, table=True):
+    __table_args__ = (
+        Index(
+            "ix_project_owner_id_owner_is_org_updated_at",
+            "owner_id",
+            "owner_is_org",
+            "updated_at",
+        ),
+    )
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field()
     description: str = Field()
@@ -61,6 +122,18 @@ class Project(SQLModel, RecordExtender, table=True):
     users: list[User] = Relationship(back_populates="projects", link_model=UserProject)
 
 
+class ProjectSummary(SQLModel, table=False):
+    id: int
+    name: str
+    description: str
+    status_code: int
+    owner_id: int
+    owner_is_org: bool
+    updated_at: datetime
+    # only with ?fields=created_at
+    created_at: datetime | None = None
+
+
 class Organization(SQLModel, RecordExtender, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field()
@@ -87,6 +160,15 @@ class TokenData(SQLModel, RecordExtender, table=False):
 
 
 class LastUsedDiagram(SQLModel, RecordExtender, table=True):
+    __table_args__ = (
+        Index("ix_lastuseddiagram_user_id_updated_at", "user_id", "updated_at"),
+        Index(
+            "ux_lastuseddiagram_user_id_diagram_id",
+            "user_id",
+            "diagram_id",
+            unique=True,
+        ),
+    )
     id: int | None = Field(default=None, primary_key=True)
     diagram_id: int = Field(foreign_key="diagrams.id")
     user_id: int = Field(foreign_key="user.id")
@@ -98,15 +180,69 @@ class NodeType(SQLModel, RecordExtender, table=True):
 
 
 class ExecutedDiagramConfig(SQLModel, RecordExtender, table=True):
+    __table_args__ = (
+        Index(
+            "ix_executeddiagramconfig_diagram_id_content_hash",
+            "diagram_id",
+            "content_hash",
+        ),
+        Index(
+            "ix_executeddiagramconfig_diagram_id_updated_at",
+            "diagram_id",
+            "updated_at",
+        ),
+    )
     id: int | None = Field(default=None, primary_key=True)
     diagram_id: int = Field(foreign_key="diagrams.id")
-    config: str
+    # config/graph hold legacy uncompressed rows only, see src/snapshots.py
+    config: str = ""
+    graph: str | None = None
+    content_hash: str | None = None
+    encoding: str = "raw"
+    payload: bytes | None = None
+    base_id: int | None = Field(default=None, foreign_key="executeddiagramconfig.id")
+    delta_depth: int = 0
+    # mode and backend of the run, answers are only reused under the same ones
+    run_settings: str | None = None
 
 
 class GeneratedContent(SQLModel, RecordExtender, table=True):
+    __table_args__ = (
+        Index(
+            "ix_generatedcontent_diagram_id_config_id", "diagram_id", "config_id"
+        ),
+    )
     id: int | None = Field(default=None, primary_key=True)
     diagram_id: int = Field(foreign_key="diagrams.id")
     type_id: int = Field(foreign_key="nodetype.id")
     config_id: int = Field(foreign_key="executeddiagramconfig.id")
     content: str
-    node_id: int
+    node_id: str
+    prompt_hash: str | None = Field(default=None, index=True)
+
+
+class RunJob(SQLModel, RecordExtender, table=True):
+    __table_args__ = (
+        Index("ix_runjob_status_id", "status", "id"),
+        Index("ux_runjob_public_id", "public_id", unique=True),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    # what clients know the run by, ids are easy to guess
+    public_id: str | None = Field(default_factory=lambda: uuid.uuid4().hex)
+    # who asked for the run, the only one who may follow it
+    user_id: int | None = Field(default=None, foreign_key="user.id")
+    diagram_id: int = Field(foreign_key="diagrams.id")
+    # queued -> running -> done | failed, see src/jobs.py
+    status: str = "queued"
+    request: str
+    worker: str | None = None
+    lease_until: datetime | None = None
+    attempts: int = 0
+    error: str | None = None
+
+
+class RunEvent(SQLModel, RecordExtender, table=True):
+    __table_args__ = (Index("ix_runevent_run_id_id", "run_id", "id"),)
+    id: int | None = Field(default=None, primary_key=True)
+    run_id: int = Field(foreign_key="runjob.id")
+    message: str
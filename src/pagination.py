@@ -0,0 +1,78 @@
+import base64
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Union
+
+from fastapi import HTTPException, Query, Request, Response
+from sqlalchemy import and_, or_
+
+
+def default_page_size():
+    return int(os.getenv("PAGE_SIZE", "50"))
+
+
+def max_page_size():
+    return int(os.getenv("PAGE_SIZE_MAX", "200"))
+
+
+def encode_cursor(updated_at: datetime, id: int) -> str:
+    raw = json.dumps([updated_at.isoformat(), id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, id = json.loads(raw)
+        return datetime.fromisoformat(updated_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@dataclass
+class Page:
+    # keyset page over (updated_at, id), newest first
+    limit: int
+    after: Union[tuple, None] = None
+
+    def apply(self, statement, model):
+        if self.after is not None:
+            updated_at, id = self.after
+            statement = statement.where(
+                or_(
+                    model.updated_at < updated_at,
+                    and_(model.updated_at == updated_at, model.id < id),
+                )
+            )
+        # one extra row tells whether there is a next page
+        return statement.order_by(model.updated_at.desc(), model.id.desc()).limit(
+            self.limit + 1
+        )
+
+    def next_cursor(self, rows) -> Union[str, None]:
+        if len(rows) <= self.limit:
+            return None
+        last = rows[self.limit - 1]
+        if isinstance(last, dict):
+            return encode_cursor(last["updated_at"], last["id"])
+        return encode_cursor(last.updated_at, last.id)
+
+
+def page_params(
+    cursor: Union[str, None] = None,
+    limit: Union[int, None] = Query(default=None, ge=1),
+) -> Page:
+    limit = min(limit or default_page_size(), max_page_size())
+    return Page(limit=limit, after=decode_cursor(cursor) if cursor else None)
+
+
+def paginated(rows, page: Page, request: Request, response: Response):
+    # the body stays a plain list, the next page is advertised in headers
+    next_cursor = page.next_cursor(rows)
+    if next_cursor is not None:
+        url = request.url.include_query_params(cursor=next_cursor, limit=page.limit)
+        response.headers["Link"] = f'<{url}>; rel="next"'
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows[: page.limit]
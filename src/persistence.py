@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import os
+from typing import Callable, List
+
+from sqlmodel import Session
+
+from . import models
+from .crud import create_generated_contents
+
+logger = logging.getLogger(__name__)
+
+
+class GeneratedContentWriter:
+    # write-behind buffer for one run: rows are queued from the event loop and
+    # inserted in bulk from a worker thread every `max_rows` rows or
+    # `max_delay` seconds, whichever comes first, and on close()
+
+    def __init__(
+        self,
+        get_db: Callable,
+        max_rows: int = None,
+        max_delay: float = None,
+    ):
+        self.get_db = get_db
+        self.max_rows = max_rows or int(os.getenv("PERSIST_BATCH_ROWS", "32"))
+        self.max_delay = (
+            max_delay
+            if max_delay is not None
+            else float(os.getenv("PERSIST_BATCH_DELAY_MS", "200")) / 1000
+        )
+        self.rows: List[models.GeneratedContent] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+
+    def add(self, row: models.GeneratedContent):
+        self.rows.append(row)
+        if len(self.rows) >= self.max_rows:
+            self._schedule_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._schedule_flush
+            )
+
+    def _schedule_flush(self):
+        task = asyncio.create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _write(self, rows: List[models.GeneratedContent]):
+        db_gen = self.get_db()
+        db: Session = next(db_gen)
+        try:
+            create_generated_contents(db, rows)
+        finally:
+            db_gen.close()
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        # one flush at a time keeps the rows in insertion order
+        async with self.lock:
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception:
+                logger.exception(f"Could not persist {len(rows)} generated rows")
+
+    async def close(self):
+        await self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
@@ -0,0 +1,58 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Tuple
+
+from .crud import touch_last_used_diagrams
+from .util import get_db
+
+logger = logging.getLogger(__name__)
+
+
+class RecentDiagramTracker:
+    # records diagram opens off the request path
+    # - the time of the open is taken right away, the write happens later
+    # - opens waiting for the writer are upserted in one transaction, repeated
+    #   opens of the same diagram collapse into one row
+
+    def __init__(self, get_db: Callable = get_db):
+        self.get_db = get_db
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="recent-diagrams"
+        )
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple[int, int], datetime] = {}
+        self.scheduled = False
+
+    def touch(self, user_id: int, diagram_id: int):
+        with self.lock:
+            self.pending[(user_id, diagram_id)] = datetime.now()
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.executor.submit(self._flush)
+
+    def _flush(self):
+        with self.lock:
+            touches, self.pending = self.pending, {}
+            self.scheduled = False
+        db_gen = self.get_db()
+        db = next(db_gen)
+        try:
+            touch_last_used_diagrams(db, touches)
+        except Exception:
+            logger.exception(f"Could not record {len(touches)} recent diagrams")
+        finally:
+            db_gen.close()
+
+    def join(self, timeout: float = None):
+        # the single worker runs jobs in order, so this waits for every flush
+        # queued before it
+        self.executor.submit(lambda: None).result(timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+recent_diagrams = RecentDiagramTracker()
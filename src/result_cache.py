@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from sqlmodel import Session, select
+
+from . import models
+from .database import engine
+
+
+def result_key(prompt: str, **settings) -> str:
+    payload = json.dumps({"prompt": prompt, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    # two tiers: an in-process LRU and the GeneratedContent table, where every
+    # generated row carries the key of the prompt that produced it
+    # one instance per process, used from whatever loop runs a node, e.g. an
+    # executor on a thread of its own next to the server's, hence the lock
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_memory(self, key: str) -> Union[str, None]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load_persistent(self, key: str) -> Union[str, None]:
+        with Session(engine) as db:
+            return db.exec(
+                select(models.GeneratedContent.content)
+                .where(models.GeneratedContent.prompt_hash == key)
+                .order_by(models.GeneratedContent.id.desc())
+                .limit(1)
+            ).first()
+
+    async def get(self, key: str) -> Union[str, None]:
+        value = self.get_memory(key)
+        if value is not None:
+            return value
+        value = await asyncio.to_thread(self.load_persistent, key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+
+result_cache = ResultCache(int(os.getenv("RESULT_CACHE_SIZE", "1024")))
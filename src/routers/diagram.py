@@ -1,12 +1,21 @@
-from dataclasses import dataclass
-from fastapi import APIRouter, Depends
-from sqlmodel import Session
+import asyncio
+import base64
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from src.crud import get_current_user, get_diagram_by_id, update_diagram_config
-from src.models import User
-from src.util import get_db
+from src.blob_store import blob_key, get_blob_store, image_media_type
+from src.authz import Permissions
+from src.crud import (
+    get_diagram_by_id_async,
+    get_diagram_thumbnail_async,
+    get_permissions,
+    update_diagram_config_async,
+)
+from src.models import DiagramRead
+from src.recent_diagrams import recent_diagrams
+from src.util import get_async_db
 from pydantic import BaseModel
-from src.resize_canvas import resize_base64_image_preserve_aspect_ratio
+from src.thumbnails import thumbnail_pipeline
 
 router = APIRouter()
 
@@ -17,18 +26,66 @@ class Data(BaseModel):
     config: str
 
 
-@router.put("/diagram")
-def update_diagrams(
-    data: Data, db: Session = Depends(get_db), user: User = Depends(get_current_user)
+@router.put("/diagram", response_model=DiagramRead)
+async def update_diagrams(
+    data: Data,
+    db: AsyncSession = Depends(get_async_db),
+    permissions: Permissions = Depends(get_permissions),
 ):
-    b64_image = resize_base64_image_preserve_aspect_ratio(data.diagram_image, 300)
-    return update_diagram_config(db, data.diagram_id, data.config, b64_image, user.id)
+    diagram = await update_diagram_config_async(
+        db, int(data.diagram_id), data.config, None, permissions
+    )
+    # the thumbnail is written by the pipeline once it is ready
+    thumbnail_pipeline.submit(diagram.id, data.diagram_image, diagram.image_hash)
+    return DiagramRead.from_diagram(diagram)
 
 
-@router.get("/diagram/{diagram_id}")
-def diagrams(
+@router.get("/diagram/{diagram_id}", response_model=DiagramRead)
+async def diagrams(
     diagram_id: int,
-    db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    permissions: Permissions = Depends(get_permissions),
 ):
-    return get_diagram_by_id(db, diagram_id, user.id)
+    diagram = await get_diagram_by_id_async(db, diagram_id, permissions)
+    recent_diagrams.touch(permissions.user_id, diagram.id)
+    return DiagramRead.from_diagram(diagram)
+
+
+@router.get("/diagram/{diagram_id}/thumbnail")
+async def diagram_thumbnail(
+    diagram_id: int,
+    request: Request,
+    v: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+    permissions: Permissions = Depends(get_permissions),
+):
+    row = await get_diagram_thumbnail_async(db, diagram_id, permissions)
+    if row is None:
+        raise HTTPException(404, "Not found")
+    thumbnail_key, image, image_hash = row
+
+    if thumbnail_key:
+        etag = f'"{thumbnail_key}"'
+    elif image:
+        # thumbnail stored inline before the blob store existed
+        etag = f'"{image_hash or blob_key(image.encode("utf-8"))}"'
+    else:
+        raise HTTPException(404, "Not found")
+
+    # only the exact version thumbnail_url hands out is cacheable for good
+    if thumbnail_key and v == thumbnail_key[:16]:
+        cache_control = "private, max-age=31536000, immutable"
+    else:
+        cache_control = "private, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if thumbnail_key:
+        content = await asyncio.to_thread(get_blob_store().get, thumbnail_key)
+        if content is None:
+            raise HTTPException(404, "Not found")
+    else:
+        content = base64.b64decode(image)
+    return Response(content, media_type=image_media_type(content), headers=headers)
@@ -1,10 +1,29 @@
+import asyncio
+import os
 from typing import Set
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
 import json
 import logging
 import traceback
 import re
-from ..crud import create_executed_config, create_generated_conted
+from ..crud import (
+    create_executed_config,
+    get_generated_contents,
+    get_last_executed_config,
+    get_websocket_user,
+    read_executed_config,
+    require_diagram_access,
+)
+from src.authz import load_permissions
+from src.connections import Connection, manager
+from src.graph_diff import dirty_nodes
+from src.jobs import enqueue_run, follow_run, get_broker
+from src.batcher import batcher
+from src.llm import get_backend
+from src.local_llm import LocalLLMDispatcher, LocalLLMError
+from src.persistence import GeneratedContentWriter
+from src.result_cache import result_cache, result_key
+from src.scheduler import requested_max_concurrency, run_dag
 from src.util import get_db
 from src import models
 
@@ -13,8 +32,10 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-
-active_connections: Set[WebSocket] = set()
+DEFAULT_LOCAL_LLM_URL = "http://localhost:1234/v1/chat/completions"
+SYSTEM_PROMPT = (
+    "You are a helpful assistant that provides concise and accurate answers."
+)
 
 
 def decrement_bracket_numbers(match):
@@ -25,160 +46,346 @@ def decrement_bracket_numbers(match):
 
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    active_connections.add(websocket)
-    logger.info(f"Number of active connections: {active_connections.__len__()}")
+async def websocket_endpoint(
+    websocket: WebSocket, user: models.User = Depends(get_websocket_user)
+):
+    connection = await manager.connect(websocket)
+    # this loop is the only reader of the socket, replies to run_local go to
+    # the dispatcher while runs go on in their own tasks and write through
+    # the connection queue
+    # runs go through the job queue (src/jobs.py), this socket only follows
+    # them; local runs need the browser, so they stay on the socket
+    local_llm = LocalLLMDispatcher(connection)
+    runs: Set[asyncio.Task] = set()
     try:
-        while True:
-            req = await websocket.receive_text()
+        while not connection.closed:
             try:
-                if req == None or req == "":
-                    break
-                req = json.loads(req)
-
-                local = req["type"] == "local"
-                await process_nodes(req, websocket, local)
-            except Exception as e:
-                logger.info("Error in json or nodes")
-                logger.error(e)
-                error_message = (
-                    traceback.format_exc()
-                )
-                logger.error(error_message)
-                raise WebSocketDisconnect(code=1000, reason="Not work")
-    except WebSocketDisconnect:
-        active_connections.remove(websocket)
+                req = await connection.receive()
+            except ValueError:
+                logger.info("Error in json")
+                continue
+            if not req:
+                break
+            if connection.received(req) or local_llm.dispatch(req):
+                continue
+
+            if req.get("type") == "local":
+                run = run_request(req, connection, user, local_llm)
+            elif req.get("type") == "run":
+                run = queue_run(req, connection, user)
+            elif req.get("type") == "subscribe":
+                run = resume_run(req.get("data"), connection, user)
+            else:
+                text = f"Unknown message type {req.get('type')}"
+                await connection.send({"type": "run_error", "data": {"text": text}})
+                continue
+            run = asyncio.create_task(run)
+            runs.add(run)
+            run.add_done_callback(runs.discard)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError - the heartbeat closed the socket under the reader
         logger.info("Peer Discnected")
-        await websocket.close()
+    finally:
+        local_llm.fail_all(LocalLLMError("disconnected"))
+        # queued runs go on without us
+        for run in runs:
+            run.cancel()
+        await manager.disconnect(connection)
 
 
-async def process_nodes(req, socket: WebSocket, local=False):
-    graph_nodes = req["data"]
+def authorize_diagram(db, user_id: int, diagram_id: int):
+    require_diagram_access(db, diagram_id, load_permissions(db, user_id))
 
-    # map_of_nodes - holds all nodes with all data from graph source of all information
-    # nodes_to_execute - holds nodes "id" that are curently loadaed to be processed or wait until resolve earlier and then starts preocessing
-    # map_of_processed_nodes - holds only output of llm
 
-    nodes_to_execute = [x["id"] for x in graph_nodes if "pointedBy" not in x.keys()]
-    executed_nodes_in_iteration = []
+async def authorize_run(req, connection: Connection, user: models.User) -> bool:
+    # a run reads and writes the diagram, the user must have access to it
+    try:
+        if not isinstance(req.get("diagram_id"), int):
+            raise HTTPException(400, "A run needs a diagram_id")
+        if not isinstance(req.get("data"), list):
+            raise HTTPException(400, "A run needs the nodes of the diagram")
+        await asyncio.to_thread(
+            run_with_db, authorize_diagram, user.id, req["diagram_id"]
+        )
+    except HTTPException as e:
+        await connection.send({"type": "run_error", "data": {"text": e.detail}})
+        return False
+    return True
+
 
-    executed_nodes_in_iteration.extend(nodes_to_execute)
+async def run_request(req, connection: Connection, user: models.User, local_llm):
+    if not await authorize_run(req, connection, user):
+        return
+    try:
+        await process_nodes(req, connection, True, local_llm)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error in nodes: {e}")
+        logger.error(traceback.format_exc())
+        await connection.send({"type": "run_error", "data": {"text": str(e)}})
+
+
+async def queue_run(req, connection: Connection, user: models.User):
+    if not await authorize_run(req, connection, user):
+        return
+    try:
+        run_id = await enqueue_run(req, user.id)
+        job = await asyncio.to_thread(get_broker().get, run_id)
+    except Exception as e:
+        logger.error(f"Could not queue run: {e}")
+        await connection.send({"type": "run_error", "data": {"text": str(e)}})
+        return
+    await connection.send({"type": "run_queued", "data": {"run_id": run_id}})
+    await follow_run(connection, job)
+
+
+async def resume_run(data, connection: Connection, user: models.User):
+    data = data if isinstance(data, dict) else {}
+    run_id = data.get("run_id")
+    after = data.get("after", 0)
+    job = None
+    if isinstance(run_id, str) and isinstance(after, int):
+        job = await asyncio.to_thread(get_broker().get, run_id)
+    try:
+        # someone else's run looks the same as no run at all
+        if job is None or job.user_id != user.id:
+            raise HTTPException(404, f"Unknown run {run_id}")
+        await asyncio.to_thread(
+            run_with_db, authorize_diagram, user.id, job.diagram_id
+        )
+    except HTTPException as e:
+        await connection.send({"type": "run_error", "data": {"text": e.detail}})
+        return
+    await follow_run(connection, job, after)
+
+
+def run_with_db(fn, *args):
+    db_gen = get_db()
+    db = next(db_gen)
+    try:
+        return fn(db, *args)
+    finally:
+        db_gen.close()
+
+
+def run_settings(local: bool, backend) -> str:
+    # what else decides the answers of a run besides the graph
+    settings = {"local": local, **({} if local else backend.settings())}
+    return json.dumps(settings, sort_keys=True)
+
+
+def load_reusable_results(db, diagram_id, graph_nodes, settings: str):
+    # outputs of generate nodes that are unchanged since the last run,
+    # together with everything upstream of them
+    # a run of another mode or backend reuses nothing, and the browser's
+    # answers of a local run are never handed to a later run
+    previous = get_last_executed_config(db, diagram_id)
+    if previous is None or previous.run_settings != settings:
+        return {}
+    if json.loads(settings)["local"]:
+        return {}
+    _, previous_graph = read_executed_config(db, previous)
+    if not previous_graph:
+        return {}
+
+    # rows are in insert order, a later row for the same node wins
+    stored = {
+        x.node_id: x for x in get_generated_contents(db, diagram_id, previous.id)
+    }
+    dirty = dirty_nodes(json.loads(previous_graph), graph_nodes, set(stored.keys()))
+    return {
+        x["id"]: stored[x["id"]]
+        for x in graph_nodes
+        if x["nodeType"] == "generate" and x["id"] not in dirty
+    }
+
+
+async def process_nodes(
+    req, socket: Connection, local=False, local_llm: LocalLLMDispatcher = None
+):
+    # socket - anything with send(message): a Connection for local runs, a
+    # RunPublisher for queued ones
+    graph_nodes = req["data"]
+
+    # map_of_nodes - holds all nodes with all data from graph source of all information
+    # map_of_processed_nodes - holds only output of llm (or text of input nodes)
 
     map_of_nodes = {}
     for x in graph_nodes:
         map_of_nodes[x["id"]] = x
 
     map_of_processed_nodes = {}
+    use_cache = req.get("cache", True)
+    # streamed calls skip the batch window of src/batcher.py
+    stream = req.get("stream", True)
+    backend = None if local else get_backend(req.get("backend"))
+    local_llm_url = os.getenv("LOCAL_LLM_URL", DEFAULT_LOCAL_LLM_URL)
 
-    for x in nodes_to_execute:
-        map_of_processed_nodes[x] = map_of_nodes[x]
-
-    exec_id = create_executed_config(
-        next(get_db()), req["diagram_id"], req["config"]
-    ).id
-
-    breaking_error = False
-    while (
-        len(map_of_processed_nodes.keys()) != len(map_of_nodes.keys())
-        and breaking_error == False
-    ):
-        for node_id in nodes_to_execute:
-            logger.warning(map_of_nodes[node_id]["nodeType"])
-            keys = map_of_processed_nodes.keys()
-            if map_of_nodes[node_id]["nodeType"] == "generate" and all(
-                key in keys for key in map_of_nodes[node_id]["pointedBy"]
-            ):
-                # ducktape prompt context
-                prompt = map_of_nodes[node_id]["data"]["text"]
-
-                prompt = re.sub(r"\{(\d+)\}", decrement_bracket_numbers, prompt)
-                context = [node for node in map_of_nodes[node_id]["pointedBy"]]
-                context = [map_of_processed_nodes[idx] for idx in context]
-                prompt = prompt.format(*context)
-
-                if local:
-                    # await socket.send_text(json.dumps({ "type": "run_local", "data": {"url": "http://localhost:1234/v1/completions", "data": {"id": node_id, "prompt": prompt}}}))
-                    await socket.send_text(
-                        json.dumps(
-                            {
-                                "type": "run_local",
-                                "data": {
-                                    "url": "http://localhost:1234/v1/chat/completions",
-                                    "data": {
-                                        "id": node_id,
-                                        "messages": [
-                                            {
-                                                "role": "system",
-                                                "content": "You are a helpful assistant that provides concise and accurate answers.",
-                                            },
-                                            {"role": "user", "content": prompt},
-                                        ],
-                                    },
-                                },
-                            }
-                        )
-                    )
+    snapshot_settings = run_settings(local, backend)
 
-                    rr = await socket.receive_text()
+    reusable = {}
+    if use_cache and not req.get("full_run", False):
+        reusable = await asyncio.to_thread(
+            run_with_db,
+            load_reusable_results,
+            req["diagram_id"],
+            graph_nodes,
+            snapshot_settings,
+        )
 
-                    sreq = json.loads(rr)
-                    if sreq["type"] == "local_llm":
-                        response_LLM = sreq["data"]
-                    elif sreq["type"] == "local_conn_error":
-                        breaking_error = True
-                        break
+    executed_config = await asyncio.to_thread(
+        run_with_db,
+        create_executed_config,
+        req["diagram_id"],
+        req["config"],
+        json.dumps(graph_nodes),
+        snapshot_settings,
+    )
+    exec_id = executed_config.id
+    writer = GeneratedContentWriter(get_db)
 
-                else:
-                    response_LLM = await askLLM(prompt)
-                    await socket.send_text(
-                        json.dumps(
-                            {
-                                "type": "update_node",
-                                "data": {"id": node_id, "data": response_LLM},
-                            }
-                        )
-                    )
-                map_of_processed_nodes[node_id] = response_LLM
-                node_type = 1 if map_of_nodes[node_id]["nodeType"] != "output" else 2
+    if local and local_llm is None:
+        raise ValueError("A local run needs the dispatcher of its socket")
+
+    async def run_node(node_id):
+        node = map_of_nodes[node_id]
+        logger.warning(node["nodeType"])
+        pointed_by = node.get("pointedBy", [])
 
-                create_generated_conted(
-                    next(get_db()),
+        if node["nodeType"] == "generate" and node_id in reusable:
+            response_LLM = reusable[node_id].content
+            map_of_processed_nodes[node_id] = response_LLM
+            await socket.send(
+                {
+                    "type": "update_node",
+                    "data": {"id": node_id, "data": response_LLM},
+                }
+            )
+            # a rerun of an identical snapshot already owns this row
+            if reusable[node_id].config_id != exec_id:
+                writer.add(
                     models.GeneratedContent(
                         diagram_id=req["diagram_id"],
                         content=response_LLM,
-                        type_id=node_type,
+                        type_id=1,
                         config_id=exec_id,
                         node_id=node_id,
+                        prompt_hash=reusable[node_id].prompt_hash,
                     ),
                 )
+        elif node["nodeType"] == "generate":
+            # ducktape prompt context
+            prompt = node["data"]["text"]
+
+            prompt = re.sub(r"\{(\d+)\}", decrement_bracket_numbers, prompt)
+            context = [map_of_processed_nodes[idx] for idx in pointed_by]
+            prompt = prompt.format(*context)
+
+            if local:
+                # whatever the browser answers stays with this run, it must
+                # never answer someone else's prompt from the cache
+                prompt_hash = None
+                response_LLM = None
             else:
-                map_of_processed_nodes[node_id] = map_of_nodes[node_id]["data"]["text"]
-
-            if map_of_nodes[node_id]["nodeType"] == "output":
-                map_of_processed_nodes[node_id] = map_of_nodes[node_id]["data"]["text"]
-                await socket.send_text(
-                    json.dumps(
-                        {
-                            "type": "update_node",
-                            "data": {"id": node_id, "data": response_LLM},
-                        }
-                    )
+                settings = {
+                    "mode": "server",
+                    "system": SYSTEM_PROMPT,
+                    **backend.settings(),
+                }
+                prompt_hash = result_key(prompt, **settings)
+                response_LLM = (
+                    await result_cache.get(prompt_hash) if use_cache else None
                 )
-                await socket.send_text(
-                    json.dumps(
-                        {"type": "run_compleated", "data": {"text": response_LLM}}
-                    )
+
+            if response_LLM is not None:
+                await socket.send(
+                    {
+                        "type": "update_node",
+                        "data": {"id": node_id, "data": response_LLM},
+                    }
+                )
+            elif local:
+                response_LLM = await local_llm.request(
+                    local_llm_url, node_id, chat_messages(prompt)
+                )
+            else:
+                if stream:
+                    chunks = []
+                    async for chunk in streamLLM(prompt, backend.name):
+                        chunks.append(chunk)
+                        await socket.send(
+                            {
+                                "type": "update_node_delta",
+                                "data": {"id": node_id, "delta": chunk},
+                            }
+                        )
+                    response_LLM = "".join(chunks)
+                else:
+                    response_LLM = await askLLM(prompt, backend.name)
+                await socket.send(
+                    {
+                        "type": "update_node",
+                        "data": {"id": node_id, "data": response_LLM},
+                    }
                 )
+            map_of_processed_nodes[node_id] = response_LLM
+            if prompt_hash is not None:
+                result_cache.put(prompt_hash, response_LLM)
 
-            executed_nodes_in_iteration.append(node_id)
-            if map_of_nodes[node_id]["nodeType"] != "output":
-                nodes_to_execute.extend(map_of_nodes[node_id]["pointingTo"])
-            nodes_to_execute = list(
-                set(nodes_to_execute) - set(executed_nodes_in_iteration)
+            writer.add(
+                models.GeneratedContent(
+                    diagram_id=req["diagram_id"],
+                    content=response_LLM,
+                    type_id=1,
+                    config_id=exec_id,
+                    node_id=node_id,
+                    prompt_hash=prompt_hash,
+                ),
+            )
+        elif node["nodeType"] == "output":
+            map_of_processed_nodes[node_id] = node["data"]["text"]
+            if pointed_by:
+                response_LLM = "\n".join(
+                    map_of_processed_nodes[idx] for idx in pointed_by
+                )
+            else:
+                response_LLM = node["data"]["text"]
+            await socket.send(
+                {
+                    "type": "update_node",
+                    "data": {"id": node_id, "data": response_LLM},
+                }
             )
-            executed_nodes_in_iteration = []
+            await socket.send(
+                {"type": "run_compleated", "data": {"text": response_LLM}}
+            )
+        else:
+            map_of_processed_nodes[node_id] = node["data"]["text"]
+
+    dependencies = {
+        node_id: node.get("pointedBy", []) for node_id, node in map_of_nodes.items()
+    }
+    max_concurrency = requested_max_concurrency(req.get("max_concurrency"))
+    try:
+        await run_dag(dependencies, run_node, max_concurrency)
+    except LocalLLMError as e:
+        logger.info(f"Run stopped by client: {e}")
+    finally:
+        await writer.close()
+
+
+def chat_messages(prompt):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+async def streamLLM(x, backend=None):
+    async for chunk in batcher.stream(get_backend(backend), chat_messages(x)):
+        yield chunk
 
 
-async def askLLM(x):
-    return x
+async def askLLM(x, backend=None):
+    return await batcher.complete(get_backend(backend), chat_messages(x))
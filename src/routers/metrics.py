@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends
+
+from src.connections import manager
+from src.crud import get_current_user
+from src.models import User
+from src.util import password_pool
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics(user: User = Depends(get_current_user)):
+    # saturation of the in-process pools and websocket queues of this worker
+    return {
+        "password_pool": password_pool.stats(),
+        "connections": manager.stats(),
+    }
@@ -1,15 +1,18 @@
 from typing import Annotated
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from pydantic import BaseModel
 from sqlmodel import Session
 
-from src.util import get_db
+from src.authz import Permissions
+from src.pagination import Page, page_params, paginated
+from src.util import get_db, requested_fields
 
 from src.crud import (
     get_current_user,
     create_organization,
     create_project_in_organization,
     get_organization_by_id,
+    get_permissions,
     get_projects_by_organization,
 )
 import src.models as models
@@ -21,9 +24,9 @@ router = APIRouter()
 def get_organization(
     org_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    permissions: Permissions = Depends(get_permissions),
 ):
-    return get_organization_by_id(db, current_user.id, org_id)
+    return get_organization_by_id(db, permissions, org_id)
 
 
 @router.post("/organization")
@@ -43,16 +46,25 @@ class OrgProjectData(BaseModel):
 @router.post("/organization/project")
 def create_project_in_org(
     data: OrgProjectData,
-    current_user: Annotated[models.User, Depends(get_current_user)],
+    permissions: Annotated[Permissions, Depends(get_permissions)],
     db: Session = Depends(get_db),
 ):
-    return create_project_in_organization(db, data.org_id, data.project, current_user)
+    return create_project_in_organization(db, data.org_id, data.project, permissions)
 
 
-@router.get("/organization/{org_id}/project")
+@router.get(
+    "/organization/{org_id}/project",
+    response_model=list[models.ProjectSummary],
+    response_model_exclude_unset=True,
+)
 def get_projects_in_org(
     org_id: int,
-    current_user: Annotated[models.User, Depends(get_current_user)],
+    request: Request,
+    response: Response,
+    permissions: Annotated[Permissions, Depends(get_permissions)],
     db: Session = Depends(get_db),
+    fields: list[str] = Depends(requested_fields),
+    page: Page = Depends(page_params),
 ):
-    return get_projects_by_organization(db, org_id, current_user.id)
+    rows = get_projects_by_organization(db, org_id, permissions, fields, page)
+    return paginated(rows, page, request, response)
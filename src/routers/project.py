@@ -1,17 +1,20 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from sqlmodel import Session
 
-from src.models import Diagram, Project, User
+from src.models import Diagram, DiagramSummary, Project, ProjectSummary, User
 from src.crud import (
     create_diagram_in_project,
     create_user_project,
     get_current_user,
     get_diagrams_in_project,
+    get_permissions,
     get_project_by_id,
     get_projects_by_user,
 )
 from src.models import Project
-from src.util import get_db
+from src.authz import Permissions
+from src.pagination import Page, page_params, paginated
+from src.util import get_db, requested_fields
 
 
 router = APIRouter()
@@ -27,27 +30,48 @@ def db_create_user_project(
     return create_user_project(db, project, user.id)
 
 
-@router.get("/project")
-def projects(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    return get_projects_by_user(db, user.id)
+@router.get(
+    "/project",
+    response_model=list[ProjectSummary],
+    response_model_exclude_unset=True,
+)
+def projects(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user),
+    fields: list[str] = Depends(requested_fields),
+    page: Page = Depends(page_params),
+):
+    rows = get_projects_by_user(db, user.id, fields, page)
+    return paginated(rows, page, request, response)
 
 
 @router.get("/project/{project_id}")
 def projects(
     project_id: int,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    permissions: Permissions = Depends(get_permissions),
 ):
-    return get_project_by_id(db, project_id, user.id)
+    return get_project_by_id(db, project_id, permissions)
 
 
-@router.get("/project/{project_id}/diagram")
+@router.get(
+    "/project/{project_id}/diagram",
+    response_model=list[DiagramSummary],
+    response_model_exclude_unset=True,
+)
 def db_create_user_project(
     project_id: int,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    permissions: Permissions = Depends(get_permissions),
+    fields: list[str] = Depends(requested_fields),
+    page: Page = Depends(page_params),
 ):
-    return get_diagrams_in_project(db, project_id, user.id)
+    rows = get_diagrams_in_project(db, project_id, permissions, fields, page)
+    return paginated(rows, page, request, response)
 
 
 @router.post("/project/{project_id}/diagram")
@@ -55,6 +79,6 @@ def db_create_user_project_diagram(
     project_id: int,
     diagram: Diagram,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    permissions: Permissions = Depends(get_permissions),
 ):
-    return create_diagram_in_project(db, diagram, project_id, user.id)
+    return create_diagram_in_project(db, diagram, project_id, permissions)
@@ -1,14 +1,21 @@
 from fastapi import APIRouter, Depends
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from src.crud import get_current_user, get_last_diagrams
-from src.models import User
-from src.util import get_db
+from src.crud import get_current_user, get_last_diagrams_async
+from src.models import DiagramSummary, User
+from src.util import get_async_db, requested_fields
 
 router = APIRouter()
 
 
-@router.get("/recent/diagrams")
-def diagrams(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    last = get_last_diagrams(db, user.id)
-    return last
+@router.get(
+    "/recent/diagrams",
+    response_model=list[DiagramSummary],
+    response_model_exclude_unset=True,
+)
+async def diagrams(
+    db: AsyncSession = Depends(get_async_db),
+    user: User = Depends(get_current_user),
+    fields: list[str] = Depends(requested_fields),
+):
+    return await get_last_diagrams_async(db, user.id, fields)
@@ -1,9 +1,10 @@
 from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from typing import Annotated
 
 from sqlmodel import SQLModel, Session
 
+from src.pagination import Page, page_params, paginated
 from src.util import get_db
 
 
@@ -30,9 +31,13 @@ def user(id: int, db: Session = Depends(get_db)):
 
 @router.get("/users", response_model=list[User])
 def users(
-    user: Annotated[str, Depends(get_current_user)], db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    user: Annotated[str, Depends(get_current_user)],
+    db: Session = Depends(get_db),
+    page: Page = Depends(page_params),
 ):
-    return get_users(db)
+    return paginated(get_users(db, page), page, request, response)
 
 
 @router.post("/users")
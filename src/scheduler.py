@@ -0,0 +1,68 @@
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, Union
+
+
+class GraphError(ValueError):
+    pass
+
+
+def default_max_concurrency() -> Union[int, None]:
+    value = int(os.getenv("GRAPH_MAX_CONCURRENCY", "8"))
+    return value if value > 0 else None
+
+
+def requested_max_concurrency(value) -> Union[int, None]:
+    # from the client: anything but a positive int gets the default, and the
+    # default is also the ceiling
+    default = default_max_concurrency()
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return default
+    return value if default is None else min(value, default)
+
+
+async def run_dag(
+    dependencies: Dict[Hashable, Iterable[Hashable]],
+    run_node: Callable[[Hashable], Awaitable[None]],
+    max_concurrency: Union[int, None] = None,
+):
+    # dependencies - node id -> ids of the nodes it waits for
+    # every node whose in-degree drops to 0 is started right away, at most
+    # max_concurrency of them at the same time (None means no cap)
+    in_degree = {node: 0 for node in dependencies}
+    dependents = {node: [] for node in dependencies}
+    for node, deps in dependencies.items():
+        for dep in deps:
+            if dep not in dependents:
+                raise GraphError(f"Node {node} depends on unknown node {dep}")
+            in_degree[node] += 1
+            dependents[dep].append(node)
+
+    ready = deque(node for node, degree in in_degree.items() if degree == 0)
+    running: Dict[asyncio.Task, Hashable] = {}
+    finished_count = 0
+
+    try:
+        while ready or running:
+            while ready and (max_concurrency is None or len(running) < max_concurrency):
+                node = ready.popleft()
+                running[asyncio.create_task(run_node(node))] = node
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node = running.pop(task)
+                task.result()
+                finished_count += 1
+                for dependent in dependents[node]:
+                    in_degree[dependent] -= 1
+                    if in_degree[dependent] == 0:
+                        ready.append(dependent)
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    if finished_count != len(dependencies):
+        raise GraphError("Graph contains a cycle")
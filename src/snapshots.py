@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import zlib
+from typing import Tuple, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ExecutedDiagramConfig payload encodings:
+#   raw         - legacy rows, config/graph live in their text columns
+#   zlib, zstd  - json [config, graph] compressed on its own
+#   <codec>+delta - compressed with the base snapshot's payload as dictionary
+
+
+def snapshot_hash(config: str, graph: Union[str, None]) -> str:
+    payload = json.dumps([config, graph])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def default_codec() -> str:
+    codec = os.getenv("EXECUTED_CONFIG_CODEC", "zstd" if zstandard else "zlib")
+    return codec if codec != "zstd" or zstandard else "zlib"
+
+
+def delta_enabled() -> bool:
+    return os.getenv("EXECUTED_CONFIG_DELTA", "0") == "1"
+
+
+def max_delta_depth() -> int:
+    return int(os.getenv("EXECUTED_CONFIG_MAX_DELTA_DEPTH", "8"))
+
+
+def _compress(codec: str, data: bytes, base: Union[bytes, None]) -> bytes:
+    if codec == "zstd":
+        dict_data = None
+        if base is not None:
+            dict_data = zstandard.ZstdCompressionDict(
+                base, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+            )
+        return zstandard.ZstdCompressor(level=3, dict_data=dict_data).compress(data)
+
+    if base is not None:
+        compressor = zlib.compressobj(6, zdict=base)
+    else:
+        compressor = zlib.compressobj(6)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(codec: str, data: bytes, base: Union[bytes, None]) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to read this snapshot")
+        dict_data = None
+        if base is not None:
+            dict_data = zstandard.ZstdCompressionDict(
+                base, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+            )
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+    if base is not None:
+        decompressor = zlib.decompressobj(zdict=base)
+    else:
+        decompressor = zlib.decompressobj()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def snapshot_bytes(config: str, graph: Union[str, None]) -> bytes:
+    return json.dumps([config, graph]).encode("utf-8")
+
+
+def encode_snapshot(
+    config: str, graph: Union[str, None], base: Union[bytes, None] = None
+) -> Tuple[str, bytes]:
+    # base - decoded snapshot_bytes of the snapshot to delta against
+    codec = default_codec()
+    payload = _compress(codec, snapshot_bytes(config, graph), base)
+    return (f"{codec}+delta" if base is not None else codec), payload
+
+
+def decode_snapshot_bytes(
+    encoding: str, payload: bytes, base: Union[bytes, None] = None
+) -> bytes:
+    codec = encoding.split("+")[0]
+    return _decompress(codec, payload, base if encoding.endswith("+delta") else None)
+
+
+def decode_snapshot(raw: bytes) -> Tuple[str, Union[str, None]]:
+    config, graph = json.loads(raw)
+    return config, graph
@@ -0,0 +1,66 @@
+# python -m src.tests.bench_thumbnails
+import base64
+import io
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from src.resize_canvas import make_thumbnail
+
+CANVAS_SIZES = [(800, 600), (1920, 1080), (2560, 1440), (3840, 2160)]
+ROUNDS = 5
+
+
+def canvas(width, height):
+    # white board with boxes, lines and text, like a saved diagram
+    random.seed(width * height)
+    img = Image.new("RGBA", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for _ in range(width * height // 40000):
+        x, y = random.randrange(width), random.randrange(height)
+        draw.rectangle((x, y, x + 160, y + 60), outline="black", fill="#e8f0fe")
+        draw.text((x + 10, y + 20), "generate node", fill="black")
+        draw.line((x, y, random.randrange(width), random.randrange(height)), "gray", 2)
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def legacy(base64_string, new_width):
+    # what resize_base64_image_preserve_aspect_ratio did before
+    img = Image.open(io.BytesIO(base64.b64decode(base64_string)))
+    new_height = int(img.height * new_width / float(img.width))
+    img = img.resize((new_width, new_height))
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def bench(fn):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        out = fn()
+    return (time.perf_counter() - start) / ROUNDS * 1000, len(out)
+
+
+def main():
+    def engine(format, quality=None):
+        return lambda image: make_thumbnail(image, 300, format=format, quality=quality)
+
+    engines = {
+        "legacy png": lambda image: legacy(image, 300),
+        "png": engine("PNG"),
+        "jpeg q80": engine("JPEG", 80),
+        "webp q80": engine("WEBP", 80),
+    }
+    print(f"{'canvas':>12} {'engine':>12} {'ms':>9} {'bytes':>9}")
+    for width, height in CANVAS_SIZES:
+        image = canvas(width, height)
+        for name, run in engines.items():
+            ms, size = bench(lambda: run(image))
+            print(f"{f'{width}x{height}':>12} {name:>12} {ms:9.1f} {size:9d}")
+
+
+if __name__ == "__main__":
+    main()
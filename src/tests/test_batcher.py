@@ -0,0 +1,122 @@
+import asyncio
+
+from src.batcher import RequestBatcher
+from src.llm import EchoBackend, LLMBackend
+
+
+class CountingBackend(EchoBackend):
+    def __init__(self):
+        super().__init__("counting", chunk_size=2)
+        self.batches = []
+        self.streams = 0
+
+    async def complete_batch(self, batch):
+        self.batches.append(len(batch))
+        await asyncio.sleep(0.01)
+        return await super().complete_batch(batch)
+
+    async def stream(self, messages):
+        self.streams += 1
+        async for chunk in super().stream(messages):
+            await asyncio.sleep(0.001)
+            yield chunk
+
+
+def messages(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_requests_in_window_are_batched():
+    backend = CountingBackend()
+    batcher = RequestBatcher(window=0.01)
+
+    async def run():
+        return await asyncio.gather(
+            *[batcher.complete(backend, messages(str(x))) for x in range(5)]
+        )
+
+    assert asyncio.run(run()) == ["0", "1", "2", "3", "4"]
+    assert backend.batches == [5]
+
+
+def test_batches_are_split_at_max_size():
+    backend = CountingBackend()
+    batcher = RequestBatcher(window=0.01, max_batch_size=2)
+
+    async def run():
+        return await asyncio.gather(
+            *[batcher.complete(backend, messages(str(x))) for x in range(5)]
+        )
+
+    assert asyncio.run(run()) == ["0", "1", "2", "3", "4"]
+    assert backend.batches == [2, 2, 1]
+
+
+def test_identical_requests_are_coalesced():
+    backend = CountingBackend()
+    batcher = RequestBatcher(window=0.01)
+
+    async def run():
+        return await asyncio.gather(
+            *[batcher.complete(backend, messages("same")) for _ in range(4)]
+        )
+
+    assert asyncio.run(run()) == ["same"] * 4
+    assert backend.batches == [1]
+    assert batcher.in_flight == {}
+
+
+def test_identical_streams_are_coalesced():
+    backend = CountingBackend()
+    batcher = RequestBatcher()
+
+    async def collect():
+        return [x async for x in batcher.stream(backend, messages("abcdef"))]
+
+    async def run():
+        return await asyncio.gather(collect(), collect())
+
+    leader, follower = asyncio.run(run())
+    assert leader == ["ab", "cd", "ef"]
+    assert follower == ["abcdef"]
+    assert backend.streams == 1
+
+
+def test_failures_reach_every_caller():
+    class FailingBackend(CountingBackend):
+        async def complete(self, messages):
+            raise RuntimeError("backend down")
+
+        complete_batch = LLMBackend.complete_batch
+
+    batcher = RequestBatcher(window=0.001)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.complete(FailingBackend(), messages("x")),
+            batcher.complete(FailingBackend(), messages("x")),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(x, RuntimeError) for x in results)
+
+
+def test_joined_callers_outlive_a_cancelled_leader():
+    backend = CountingBackend()
+    batcher = RequestBatcher()
+
+    async def collect():
+        return [x async for x in batcher.stream(backend, messages("abcdef"))]
+
+    async def run():
+        leader = asyncio.create_task(collect())
+        await asyncio.sleep(0)
+        streamer = asyncio.create_task(collect())
+        completer = asyncio.create_task(batcher.complete(backend, messages("abcdef")))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.gather(streamer, completer)
+
+    assert asyncio.run(run()) == [["ab", "cd", "ef"], "abcdef"]
+    assert backend.streams == 2
@@ -0,0 +1,175 @@
+import asyncio
+import json
+
+import pytest
+
+from src.connections import Connection
+
+
+class SlowWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.closed_with = None
+
+    async def send_text(self, text):
+        await self.gate.wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def update(node_id, data):
+    return {"type": "update_node", "data": {"id": node_id, "data": data}}
+
+
+def delta(node_id, text):
+    return {"type": "update_node_delta", "data": {"id": node_id, "delta": text}}
+
+
+def test_full_queue_merges_superseded_node_updates():
+    async def run():
+        websocket = SlowWebSocket()
+        connection = Connection(websocket, max_queue=3, ping_interval=0)
+        connection.start()
+
+        # the writer holds the first message, three more fill the queue
+        await connection.send({"type": "run_local"})
+        await asyncio.sleep(0)
+        for message in [delta("a", "he"), update("b", "x"), delta("a", "llo")]:
+            await connection.send(message)
+        await asyncio.wait_for(connection.send(delta("a", "!")), 1)
+        assert connection.stats()["queued"] == 3
+        await asyncio.wait_for(connection.send(update("b", "y")), 1)
+        assert list(connection.queue) == [
+            delta("a", "he"),
+            delta("a", "llo!"),
+            update("b", "y"),
+        ]
+
+        websocket.gate.set()
+        await asyncio.sleep(0.01)
+        await connection.close()
+        return websocket.sent, connection.stats()
+
+    sent, stats = asyncio.run(run())
+    assert [x["type"] for x in sent] == [
+        "run_local",
+        "update_node_delta",
+        "update_node_delta",
+        "update_node",
+    ]
+    assert stats["queued"] == 0 and stats["merged"] == 2
+
+
+def test_full_queue_blocks_until_the_writer_catches_up():
+    async def run():
+        websocket = SlowWebSocket()
+        connection = Connection(websocket, max_queue=1, ping_interval=0)
+        connection.start()
+        await connection.send({"type": "first"})
+        await asyncio.sleep(0)
+        await connection.send({"type": "second"})
+
+        blocked = asyncio.create_task(connection.send({"type": "third"}))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        websocket.gate.set()
+        await asyncio.wait_for(blocked, 1)
+        await asyncio.sleep(0.01)
+        await connection.close()
+        return [x["type"] for x in websocket.sent]
+
+    assert asyncio.run(run()) == ["first", "second", "third"]
+
+
+def test_heartbeat_closes_only_idle_clients_that_answer_pings():
+    async def run(*after):
+        websocket = SlowWebSocket()
+        websocket.gate.set()
+        connection = Connection(
+            websocket, max_queue=8, ping_interval=0.01, idle_timeout=0.05
+        )
+        connection.start()
+
+        assert connection.received({"type": "ping"})
+        assert not connection.received({"type": "run"})
+        for message in after:
+            connection.received(message)
+        await asyncio.sleep(0.2)
+        await connection.close()
+        return websocket
+
+    # a client that never answered may just not know the heartbeat
+    websocket = asyncio.run(run())
+    types = [x["type"] for x in websocket.sent]
+    assert types[0] == "pong" and "ping" in types
+    assert websocket.closed_with is None
+
+    websocket = asyncio.run(run({"type": "pong"}))
+    assert websocket.closed_with == 1001
+
+    # and keeps counting as one whatever it sends after the pong
+    websocket = asyncio.run(run({"type": "pong"}, {"type": "local_llm"}))
+    assert websocket.closed_with == 1001
+
+
+def test_idle_close_is_opt_in(monkeypatch):
+    monkeypatch.delenv("WS_IDLE_TIMEOUT", raising=False)
+
+    async def run():
+        connection = Connection(SlowWebSocket(), max_queue=8, ping_interval=0.01)
+        connection.start()
+        tasks = len(connection.tasks)
+        await connection.close()
+        return tasks
+
+    assert asyncio.run(run()) == 1
+
+
+def test_codec_negotiation(monkeypatch):
+    from src import ws_codec
+
+    codec, subprotocol = ws_codec.negotiate([])
+    assert subprotocol is None and not codec.binary
+
+    monkeypatch.setattr(ws_codec, "msgpack", None)
+    codec, subprotocol = ws_codec.negotiate(["diag.msgpack", "diag.json"])
+    assert subprotocol == "diag.json"
+    message = update("a", "ż" * 3)
+    assert codec.decode(codec.encode(message)) == message
+
+
+def test_msgpack_codec_round_trip():
+    pytest.importorskip("msgpack")
+    from src.ws_codec import MsgpackCodec, negotiate
+
+    codec, subprotocol = negotiate(["diag.json", "diag.msgpack"])
+    assert subprotocol == "diag.msgpack" and codec.binary
+    message = update("a", "x" * 1000)
+    assert codec.decode(codec.encode(message)) == message
+    assert MsgpackCodec().decode('{"type": "ping"}') == {"type": "ping"}
+
+
+def test_websocket_negotiates_subprotocol_and_answers_pings():
+    from src.tests.test_sql_app import auth_header, client, create_user, init_db
+    from src.ws_codec import negotiate
+
+    init_db()
+    create_user()
+    codec, subprotocol = negotiate(["diag.msgpack", "diag.json"])
+    with client.websocket_connect(
+        "/ws", subprotocols=["diag.msgpack", "diag.json"], headers=auth_header()
+    ) as ws:
+        assert ws.accepted_subprotocol == subprotocol
+        # valid json that isn't an object is skipped like broken json
+        for junk in ("[]", "1", '"x"', "{"):
+            ws.send_text(junk)
+        ws.send_text(json.dumps({"type": "ping"}))
+        if codec.binary:
+            reply = codec.decode(ws.receive_bytes())
+        else:
+            reply = codec.decode(ws.receive_text())
+    assert reply == {"type": "pong"}
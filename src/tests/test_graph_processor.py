@@ -0,0 +1,799 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import Session, select
+
+from src import crud, models
+from src.graph_diff import dirty_nodes
+from src.llm import EchoBackend, backends, register_backend
+from src import result_cache as result_cache_module
+from src.result_cache import result_cache
+from src.routers import graph_processor
+from src.scheduler import GraphError, requested_max_concurrency, run_dag
+from src.tests.test_sql_app import engine, init_db, override_get_db
+
+TST_JSON = os.path.join(os.path.dirname(__file__), "..", "tst.json")
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+class RecordingBackend(EchoBackend):
+    def __init__(self):
+        super().__init__("recording")
+        self.prompts = []
+
+    async def stream(self, messages):
+        self.prompts.append(messages[-1]["content"])
+        async for chunk in super().stream(messages):
+            yield chunk
+
+
+def load_request():
+    req = json.loads(open(TST_JSON).read())
+    req["diagram_id"] = 1
+    req["config"] = "{}"
+    return req
+
+
+@pytest.fixture
+def test_db(monkeypatch):
+    init_db()
+    monkeypatch.setattr(graph_processor, "get_db", override_get_db)
+    monkeypatch.setattr(result_cache_module, "engine", engine)
+    result_cache.clear()
+
+
+@pytest.fixture
+def diagram_owner(test_db):
+    # the user behind the socket, with access to diagram 1
+    from src.tests.initialize_data import init_status_code
+    from src.tests import test_sql_app as app_tests
+
+    init_status_code(Session(engine))
+    app_tests.create_user()
+    headers = app_tests.auth_header()
+    for url, body in [
+        ("/project", app_tests.TEST_PROJECT),
+        ("/project/1/diagram", app_tests.TEST_DIAGRAM),
+    ]:
+        response = app_tests.client.post(url, json=body, headers=headers)
+        assert response.status_code == 200, response.text
+    return headers
+
+
+@pytest.fixture
+def worker():
+    # like python -m src.jobs, a loop of its own next to the test client's
+    from src.jobs import run_executor
+
+    thread = threading.Thread(target=asyncio.run, args=(run_executor.run(),))
+    thread.start()
+    yield run_executor
+    while run_executor.loop is None and thread.is_alive():
+        time.sleep(0.01)
+    run_executor.stop()
+    thread.join(10)
+
+
+def receive_until(ws, last_type):
+    messages = [json.loads(ws.receive_text())]
+    while messages[-1]["type"] != last_type:
+        messages.append(json.loads(ws.receive_text()))
+    return messages
+
+
+@pytest.fixture
+def no_result_cache(monkeypatch):
+    # whatever isn't prompted again was reused from the last run
+    async def get(key):
+        return None
+
+    monkeypatch.setattr(result_cache, "get", get)
+
+
+@pytest.fixture
+def recording_backend():
+    backend = RecordingBackend()
+    register_backend(backend)
+    yield backend
+    backends.pop(backend.name)
+
+
+def test_run_dag_respects_dependencies():
+    order = []
+
+    async def run_node(node):
+        await asyncio.sleep(0)
+        order.append(node)
+
+    deps = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"]}
+    asyncio.run(run_dag(deps, run_node))
+
+    assert order[0] == "a"
+    assert order[-1] == "d"
+    assert set(order) == set(deps)
+
+
+def test_run_dag_runs_independent_branches_concurrently():
+    async def run_node(node):
+        await asyncio.sleep(0.1)
+
+    deps = {str(x): [] for x in range(10)}
+    start = time.perf_counter()
+    asyncio.run(run_dag(deps, run_node))
+    assert time.perf_counter() - start < 0.5
+
+
+def test_run_dag_concurrency_cap():
+    running = 0
+    peak = 0
+
+    async def run_node(node):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    deps = {str(x): [] for x in range(10)}
+    asyncio.run(run_dag(deps, run_node, max_concurrency=3))
+    assert peak == 3
+
+
+def test_run_dag_rejects_cycles_and_unknown_nodes():
+    async def run_node(node):
+        pass
+
+    with pytest.raises(GraphError):
+        asyncio.run(run_dag({"a": ["b"], "b": ["a"]}, run_node))
+    with pytest.raises(GraphError):
+        asyncio.run(run_dag({"a": ["missing"]}, run_node))
+
+
+def test_process_nodes(test_db):
+    socket = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(load_request(), socket))
+
+    assert socket.sent[-1] == {
+        "type": "run_compleated",
+        "data": {"text": "review and add other data to convert Hilary and Jordan into one json"},
+    }
+    contents = Session(engine).exec(select(models.GeneratedContent)).all()
+    assert len(contents) == 2
+
+
+def test_process_nodes_local_abort(test_db):
+    from src.local_llm import LocalLLMDispatcher
+
+    async def run():
+        socket = FakeSocket()
+        local_llm = LocalLLMDispatcher(socket)
+        run = asyncio.create_task(
+            graph_processor.process_nodes(load_request(), socket, True, local_llm)
+        )
+        while not socket.sent:
+            await asyncio.sleep(0.01)
+        local_llm.dispatch({"type": "local_conn_error", "data": ""})
+        await asyncio.wait_for(run, 5)
+        return socket.sent
+
+    assert [x["type"] for x in asyncio.run(run())] == ["run_local"]
+
+
+def test_process_nodes_reuses_cached_results(test_db, recording_backend):
+    prompts = recording_backend.prompts
+    req = load_request()
+    req["backend"] = recording_backend.name
+
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 2
+
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 2
+
+    # the persistent tier answers once the in-process tier is gone
+    result_cache.clear()
+    socket = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(req, socket))
+    assert len(prompts) == 2
+    assert socket.sent[-1]["type"] == "run_compleated"
+
+    req["data"][2]["data"]["text"] = "merge {} and {}"
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 4
+
+
+def test_requested_max_concurrency(monkeypatch):
+    monkeypatch.setenv("GRAPH_MAX_CONCURRENCY", "8")
+    assert requested_max_concurrency(None) == 8
+    assert requested_max_concurrency(2) == 2
+    assert requested_max_concurrency(100) == 8
+    for value in (0, -1, "4", 2.5, True):
+        assert requested_max_concurrency(value) == 8
+
+
+def test_process_nodes_ignores_bad_max_concurrency(test_db):
+    req = load_request()
+    req["max_concurrency"] = 0
+    socket = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(req, socket))
+    assert socket.sent[-1]["type"] == "run_compleated"
+
+
+def test_dirty_nodes():
+    nodes = load_request()["data"]
+    generate_ids = {nodes[2]["id"], nodes[4]["id"]}
+
+    assert dirty_nodes(nodes, nodes, generate_ids) == set()
+    assert dirty_nodes([], nodes, generate_ids) == {x["id"] for x in nodes}
+
+    changed = json.loads(json.dumps(nodes))
+    changed[4]["data"]["text"] = "shorten {}"
+    assert dirty_nodes(nodes, changed, generate_ids) == {
+        nodes[4]["id"],
+        nodes[3]["id"],
+    }
+    assert dirty_nodes(nodes, nodes, {nodes[4]["id"]}) == {
+        nodes[2]["id"],
+        nodes[4]["id"],
+        nodes[3]["id"],
+    }
+
+
+def test_process_nodes_reruns_only_dirty_subgraph(
+    test_db, recording_backend, no_result_cache
+):
+    prompts = recording_backend.prompts
+    req = load_request()
+    req["backend"] = recording_backend.name
+
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 2
+
+    req["data"][4]["data"]["text"] = "shorten {}"
+    socket = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(req, socket))
+    assert prompts[2:] == ["shorten convert Hilary and Jordan into one json"]
+    assert socket.sent[-1]["data"]["text"] == prompts[2]
+
+    req["full_run"] = True
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 5
+
+
+def test_results_are_reused_only_under_the_same_settings(
+    test_db, recording_backend, no_result_cache
+):
+    prompts = recording_backend.prompts
+    req = load_request()
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+
+    # the echo answers don't count for another backend
+    req["backend"] = recording_backend.name
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 2
+
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 2
+
+    req["cache"] = False
+    asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+    assert len(prompts) == 4
+
+    # the browser's answers stay with the local run that got them
+    local = graph_processor.run_settings(True, None)
+    server = graph_processor.run_settings(False, recording_backend)
+    with Session(engine) as db:
+        config = crud.create_executed_config(
+            db, 1, "{}", json.dumps(req["data"]), local
+        )
+        db.add_all(
+            models.GeneratedContent(
+                diagram_id=1, type_id=1, config_id=config.id, content="x", node_id=x
+            )
+            for x in [x["id"] for x in req["data"] if x["nodeType"] == "generate"]
+        )
+        db.commit()
+        for settings in (local, server):
+            reusable = graph_processor.load_reusable_results(
+                db, 1, req["data"], settings
+            )
+            assert reusable == {}
+
+
+def test_process_nodes_streams_deltas(test_db, monkeypatch):
+    monkeypatch.setenv("LLM_STUB_CHUNK_SIZE", "4")
+    socket = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(load_request(), socket))
+
+    generate_id = load_request()["data"][2]["id"]
+    deltas = [
+        x["data"]["delta"]
+        for x in socket.sent
+        if x["type"] == "update_node_delta" and x["data"]["id"] == generate_id
+    ]
+    final = [
+        x["data"]["data"]
+        for x in socket.sent
+        if x["type"] == "update_node" and x["data"]["id"] == generate_id
+    ]
+    assert len(deltas) > 1
+    assert final == ["".join(deltas)] == ["convert Hilary and Jordan into one json"]
+
+
+def test_generated_content_writer_flushes_in_bulk(test_db, monkeypatch):
+    from src import persistence
+
+    flushed = []
+    write = persistence.create_generated_contents
+
+    def create_generated_contents(db, rows):
+        flushed.append(len(rows))
+        write(db, rows)
+
+    monkeypatch.setattr(
+        persistence, "create_generated_contents", create_generated_contents
+    )
+
+    def row(x):
+        return models.GeneratedContent(
+            diagram_id=1, type_id=1, config_id=1, content=str(x), node_id=str(x)
+        )
+
+    async def run():
+        writer = persistence.GeneratedContentWriter(override_get_db, max_rows=2)
+        for x in range(5):
+            writer.add(row(x))
+            await asyncio.sleep(0)
+        await writer.close()
+
+    asyncio.run(run())
+    assert flushed == [2, 2, 1]
+    contents = Session(engine).exec(select(models.GeneratedContent)).all()
+    assert [x.content for x in contents] == ["0", "1", "2", "3", "4"]
+
+
+def test_identical_runs_share_one_snapshot(test_db, recording_backend):
+    req = load_request()
+    req["backend"] = recording_backend.name
+
+    for _ in range(3):
+        asyncio.run(graph_processor.process_nodes(req, FakeSocket()))
+
+    with Session(engine) as db:
+        configs = db.exec(select(models.ExecutedDiagramConfig)).all()
+        contents = db.exec(select(models.GeneratedContent)).all()
+        assert len(configs) == 1
+        assert configs[0].encoding != "raw" and configs[0].config == ""
+        assert crud.read_executed_config(db, configs[0]) == (
+            "{}",
+            json.dumps(req["data"]),
+        )
+    assert len(contents) == 2
+
+
+def test_snapshot_deltas_round_trip(test_db, monkeypatch):
+    monkeypatch.setenv("EXECUTED_CONFIG_DELTA", "1")
+    monkeypatch.setenv("EXECUTED_CONFIG_MAX_DELTA_DEPTH", "2")
+    graph = json.dumps(load_request()["data"])
+    configs = [json.dumps({"version": x, "nodes": ["a"] * 50}) for x in range(4)]
+
+    with Session(engine) as db:
+        rows = [crud.create_executed_config(db, 1, x, graph) for x in configs]
+        assert [x.delta_depth for x in rows] == [0, 1, 2, 0]
+        assert rows[1].encoding.endswith("+delta")
+        assert rows[1].base_id == rows[0].id
+        assert len(rows[1].payload) < len(rows[0].payload)
+
+        db.expunge_all()
+        for row, config in zip(rows, configs):
+            row = db.get(models.ExecutedDiagramConfig, row.id)
+            assert crud.read_executed_config(db, row) == (config, graph)
+
+        # going back to an older snapshot reuses its row
+        assert crud.create_executed_config(db, 1, configs[0], graph).id == rows[0].id
+        assert crud.get_last_executed_config(db, 1).id == rows[0].id
+
+
+def fan_out_request():
+    def node(id, nodeType, text, pointedBy=()):
+        return {
+            "id": id,
+            "nodeType": nodeType,
+            "data": {"text": text},
+            "pointedBy": list(pointedBy),
+        }
+
+    return {
+        "type": "local",
+        "diagram_id": 1,
+        "config": "{}",
+        "cache": False,
+        "data": [
+            node("a", "input", "Hilary"),
+            node("b", "input", "Jordan"),
+            node("left", "generate", "greet {}", ["a"]),
+            node("right", "generate", "greet {}", ["b"]),
+            node("out", "output", "", ["left", "right"]),
+        ],
+    }
+
+
+def test_local_requests_are_multiplexed(diagram_owner):
+    from src.tests.test_sql_app import client
+
+    with client.websocket_connect("/ws", headers=diagram_owner) as ws:
+        ws.send_text(json.dumps(fan_out_request()))
+        requests = [json.loads(ws.receive_text()) for _ in range(2)]
+        assert [x["type"] for x in requests] == ["run_local", "run_local"]
+
+        # an unrelated message in between is not taken for a reply
+        ws.send_text(json.dumps({"type": "ping"}))
+        for x in reversed(requests):
+            prompt = x["data"]["data"]["messages"][-1]["content"]
+            ws.send_text(
+                json.dumps(
+                    {
+                        "type": "local_llm",
+                        "request_id": x["data"]["request_id"],
+                        "data": prompt.upper(),
+                    }
+                )
+            )
+        message = json.loads(ws.receive_text())
+        while message["type"] != "run_compleated":
+            message = json.loads(ws.receive_text())
+
+    assert message["data"]["text"] == "GREET HILARY\nGREET JORDAN"
+
+    # client supplied answers are neither cached nor findable by prompt
+    assert result_cache.entries == {}
+    rows = Session(engine).exec(select(models.GeneratedContent)).all()
+    assert {x.prompt_hash for x in rows} <= {None}
+
+
+def test_local_request_times_out():
+    from src.local_llm import LocalLLMDispatcher, LocalLLMError
+
+    async def run():
+        dispatcher = LocalLLMDispatcher(FakeSocket(), timeout=0.01)
+        with pytest.raises(LocalLLMError, match="local_llm_timeout"):
+            await dispatcher.request("url", "node", [])
+        assert dispatcher.pending == {}
+
+    asyncio.run(run())
+
+
+def test_jobs_are_claimed_once_and_reclaimed_after_the_lease(test_db):
+    from sqlalchemy import update
+
+    from src.jobs import DatabaseBroker
+
+    broker = DatabaseBroker(override_get_db, lease_seconds=60, max_attempts=2)
+    first = broker.enqueue(1, 1, {"data": []})
+    second = broker.enqueue(1, 1, {"data": []})
+    assert len({first, second}) == 2 and len(first) == 32
+
+    job = broker.claim("a")
+    assert job.public_id == first
+    assert broker.claim("b").public_id == second
+    assert broker.claim("c") is None
+
+    def expire(run_id):
+        with Session(engine) as db:
+            db.execute(
+                update(models.RunJob)
+                .where(models.RunJob.id == run_id)
+                .values(lease_until=datetime.now() - timedelta(seconds=1))
+            )
+            db.commit()
+
+    # worker a went quiet, c takes over and a can't finish any more
+    expire(job.id)
+    reclaimed = broker.claim("c")
+    assert (reclaimed.id, reclaimed.worker, reclaimed.attempts) == (job.id, "c", 2)
+    assert not broker.finish(job.id, "a", "done")
+    assert broker.renew(job.id, "c")
+
+    # out of attempts
+    expire(job.id)
+    assert broker.claim("d") is None
+    assert broker.get(first).status == "failed"
+    assert broker.events(job.id)[-1][1]["data"] == {
+        "run_id": first,
+        "status": "failed",
+        "error": "worker lost",
+    }
+
+    assert broker.finish(job.id + 1, "b", "done")
+    assert broker.get(second).status == "done"
+
+
+def test_finished_runs_are_pruned(test_db):
+    from sqlalchemy import update
+
+    from src.jobs import DatabaseBroker
+
+    broker = DatabaseBroker(override_get_db)
+    finished = broker.enqueue(1, 1, {"data": []})
+    job = broker.claim("a")
+    broker.publish(job.id, {"type": "update_node"})
+    broker.finish(job.id, "a", "done")
+    running = broker.enqueue(1, 1, {"data": []})
+    broker.claim("a")
+
+    with Session(engine) as db:
+        db.execute(
+            update(models.RunJob).values(
+                updated_at=datetime.now() - timedelta(days=2)
+            )
+        )
+        db.commit()
+    assert broker.prune(datetime.now() - timedelta(days=1)) == 1
+
+    assert broker.get(finished) is None
+    assert broker.events(job.id) == []
+    assert broker.get(running).status == "running"
+
+
+def test_stored_events_reach_followers_in_order():
+    from src.jobs import JobBroker, RunHub, RunPublisher
+
+    class SlowBroker(JobBroker):
+        # odd events take longer to store than the even ones after them
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.last = 0
+
+        def publish(self, run_id, message):
+            with self.lock:
+                self.last += 1
+                event_id = self.last
+            time.sleep(0.02 if event_id % 2 else 0)
+            return event_id
+
+    async def run():
+        hub = RunHub()
+        queue = hub.subscribe(1)
+        publisher = RunPublisher(1, SlowBroker(), hub)
+        await asyncio.gather(
+            *[publisher.send({"type": "update_node"}) for _ in range(6)]
+        )
+        await asyncio.sleep(0)
+        return [queue.get_nowait()[0] for _ in range(6)]
+
+    assert asyncio.run(run()) == [1, 2, 3, 4, 5, 6]
+
+
+def test_run_that_lost_its_lease_is_cancelled(monkeypatch):
+    from src.jobs import JobBroker, RunExecutor, RunHub
+
+    started = []
+    cancelled = []
+
+    async def process_nodes(req, socket):
+        started.append(req)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(req)
+            raise
+
+    class LostLease(JobBroker):
+        lease_seconds = 0.03
+
+        def __init__(self):
+            self.finished = []
+
+        def renew(self, run_id, worker):
+            return False
+
+        def finish(self, run_id, worker, status, error=None):
+            self.finished.append(status)
+            return True
+
+    monkeypatch.setattr(graph_processor, "process_nodes", process_nodes)
+    broker = LostLease()
+    executor = RunExecutor(broker, RunHub(), workers=1)
+    job = models.RunJob(id=1, public_id="x", diagram_id=1, request="{}")
+
+    asyncio.run(asyncio.wait_for(executor.execute(job), 5))
+    assert started == cancelled == [{}]
+    # the job belongs to whoever claimed it since
+    assert broker.finished == []
+
+
+def test_renew_errors_are_retried_until_the_lease_runs_out(monkeypatch):
+    from src.jobs import JobBroker, RunExecutor, RunHub
+
+    async def process_nodes(req, socket):
+        await asyncio.sleep(req["seconds"])
+
+    class LockedBroker(JobBroker):
+        lease_seconds = 0.06
+
+        def __init__(self, failures):
+            self.failures = failures
+            self.finished = []
+
+        def renew(self, run_id, worker):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("database is locked")
+            return True
+
+        def finish(self, run_id, worker, status, error=None):
+            self.finished.append(status)
+            return True
+
+        def publish(self, run_id, message):
+            return 1
+
+    monkeypatch.setattr(graph_processor, "process_nodes", process_nodes)
+
+    def execute(failures):
+        broker = LockedBroker(failures)
+        executor = RunExecutor(broker, RunHub(), workers=1)
+        job = models.RunJob(
+            id=1, public_id="x", diagram_id=1, request='{"seconds": 0.2}'
+        )
+        asyncio.run(asyncio.wait_for(executor.execute(job), 5))
+        return broker.finished
+
+    # one failed renewal, the next one keeps the lease
+    assert execute(1) == ["done"]
+    # the lease can run out, the run stops before it is claimed again
+    assert execute(100) == []
+
+
+def test_a_failed_finish_keeps_the_worker_going(monkeypatch):
+    from src.jobs import JobBroker, RunExecutor, RunHub
+
+    async def process_nodes(req, socket):
+        pass
+
+    class BrokenBroker(JobBroker):
+        def __init__(self):
+            self.jobs = [
+                models.RunJob(id=x, public_id=str(x), diagram_id=1, request="{}")
+                for x in (1, 2)
+            ]
+            self.finished = []
+
+        def claim(self, worker):
+            if not self.jobs:
+                executor.stop()
+                return None
+            return self.jobs.pop(0)
+
+        def finish(self, run_id, worker, status, error=None):
+            self.finished.append(run_id)
+            raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(graph_processor, "process_nodes", process_nodes)
+    broker = BrokenBroker()
+    executor = RunExecutor(broker, RunHub(), workers=1, poll_interval=0.01)
+    asyncio.run(asyncio.wait_for(executor.run(), 5))
+    assert broker.finished == [1, 2]
+
+
+def test_queued_run_survives_disconnect_and_replays(diagram_owner, worker):
+    from src.jobs import get_broker
+    from src.tests.test_sql_app import client
+
+    with client.websocket_connect("/ws", headers=diagram_owner) as ws:
+        ws.send_text(json.dumps(load_request()))
+        queued = json.loads(ws.receive_text())
+    assert queued["type"] == "run_queued"
+    run_id = queued["data"]["run_id"]
+
+    # the run goes on without a socket
+    deadline = time.monotonic() + 10
+    while get_broker().get(run_id).status != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+    with client.websocket_connect("/ws", headers=diagram_owner) as ws:
+        ws.send_text(json.dumps({"type": "subscribe", "data": {"run_id": run_id}}))
+        messages = receive_until(ws, "run_status")
+
+    assert {x["run_id"] for x in messages} == {run_id}
+    # deltas are live only, stored events come back in order
+    assert "update_node_delta" not in [x["type"] for x in messages]
+    event_ids = [x["event_id"] for x in messages]
+    assert event_ids == sorted(event_ids)
+    assert messages[-2]["type"] == "run_compleated"
+    assert messages[-2]["data"]["text"] == (
+        "review and add other data to convert Hilary and Jordan into one json"
+    )
+    assert messages[-1]["data"] == {"run_id": run_id, "status": "done", "error": None}
+
+
+def test_queued_run_streams_in_order(diagram_owner, worker):
+    from src.tests.test_sql_app import client
+
+    req = load_request()
+    req["cache"] = False
+    req["full_run"] = True
+    with client.websocket_connect("/ws", headers=diagram_owner) as ws:
+        ws.send_text(json.dumps(req))
+        messages = receive_until(ws, "run_status")
+
+    direct = FakeSocket()
+    asyncio.run(graph_processor.process_nodes(req, direct))
+
+    # deltas published before the socket followed the run are gone, the
+    # stored events all come through
+    def stored(messages):
+        return [x for x in messages if x["type"] != "update_node_delta"]
+
+    assert [x["type"] for x in stored(messages[1:-1])] == [
+        x["type"] for x in stored(direct.sent)
+    ]
+    assert [x["data"] for x in stored(messages[1:-1])] == [
+        x["data"] for x in stored(direct.sent)
+    ]
+
+
+def test_runs_need_an_authorized_socket(diagram_owner):
+    from starlette.websockets import WebSocketDisconnect
+
+    from src.tests.test_sql_app import client
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/ws"):
+            pass
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/ws?token=forged"):
+            pass
+
+    token = diagram_owner["Authorization"].split()[1]
+    with client.websocket_connect(f"/ws?token={token}") as ws:
+        errors = []
+        for message in [
+            {"type": "rnu", "diagram_id": 1, "data": []},
+            {**load_request(), "diagram_id": 99},
+            {**load_request(), "diagram_id": "1"},
+            {"type": "local", "diagram_id": 99, "data": []},
+            {"type": "subscribe", "data": {"run_id": "0" * 32}},
+            {"type": "subscribe", "data": 1},
+        ]:
+            ws.send_text(json.dumps(message))
+            reply = json.loads(ws.receive_text())
+            assert reply["type"] == "run_error"
+            errors.append(reply["data"]["text"])
+
+    assert errors[0] == "Unknown message type rnu"
+    assert errors[1] == "Not found"
+    assert errors[2] == "A run needs a diagram_id"
+    assert errors[4].startswith("Unknown run")
+    assert Session(engine).exec(select(models.RunJob)).all() == []
+
+
+def test_runs_can_only_be_followed_by_their_owner(diagram_owner, worker):
+    from src.tests.test_sql_app import client
+
+    with client.websocket_connect("/ws", headers=diagram_owner) as ws:
+        ws.send_text(json.dumps(load_request()))
+        run_id = receive_until(ws, "run_status")[0]["data"]["run_id"]
+
+    other = {"email": "other@example.com", "username": "other", "password": "pw"}
+    assert client.post("/users/", json=other).status_code == 200
+    token = client.post(
+        "/token", data={"username": other["email"], "password": other["password"]}
+    ).json()["access_token"]
+    with client.websocket_connect(f"/ws?token={token}") as ws:
+        ws.send_text(json.dumps({"type": "subscribe", "data": {"run_id": run_id}}))
+        reply = json.loads(ws.receive_text())
+    assert reply == {"type": "run_error", "data": {"text": f"Unknown run {run_id}"}}
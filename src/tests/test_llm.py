@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+import httpx
+
+from src.llm import ChatCompletionBackend, EchoBackend, get_http_client
+
+MESSAGES = [{"role": "user", "content": "hello there"}]
+
+
+def fake_server(request: httpx.Request):
+    body = json.loads(request.content)
+    text = body["messages"][-1]["content"].upper()
+    if not body["stream"]:
+        return httpx.Response(
+            200, json={"choices": [{"message": {"role": "assistant", "content": text}}]}
+        )
+    events = [
+        "data: " + json.dumps({"choices": [{"delta": {"content": word}}]})
+        for word in text.split(" ")
+    ]
+    events.append("data: [DONE]")
+    return httpx.Response(200, text="\n\n".join(events))
+
+
+def fake_backend(**kwargs):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(fake_server))
+    return ChatCompletionBackend(
+        "fake", "http://llm.test/v1/chat/completions", client=client, **kwargs
+    )
+
+
+def test_chat_completion_backend_complete():
+    assert asyncio.run(fake_backend().complete(MESSAGES)) == "HELLO THERE"
+
+
+def test_chat_completion_backend_stream():
+    async def collect():
+        return [chunk async for chunk in fake_backend().stream(MESSAGES)]
+
+    assert asyncio.run(collect()) == ["HELLO", "THERE"]
+
+
+def test_chat_completion_backend_bounded_concurrency():
+    backend = fake_backend(max_concurrency=2)
+    running = 0
+    peak = 0
+    original = backend.client.post
+
+    async def post(*args, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return await original(*args, **kwargs)
+
+    backend.client.post = post
+
+    async def run():
+        await asyncio.gather(*[backend.complete(MESSAGES) for _ in range(6)])
+
+    asyncio.run(run())
+    assert peak == 2
+
+
+def test_http_client_is_shared():
+    assert get_http_client() is get_http_client()
+
+
+def test_echo_backend_chunks():
+    async def collect():
+        backend = EchoBackend(chunk_size=5)
+        return [chunk async for chunk in backend.stream(MESSAGES)]
+
+    assert asyncio.run(collect()) == ["hello", " ther", "e"]
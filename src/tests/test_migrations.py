@@ -0,0 +1,177 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import crud, models
+from src.authz import access_cache, load_permissions
+from src.database import async_database_url
+from src.migrations import (
+    MIGRATIONS,
+    baseline_metadata,
+    current_version,
+    default_sql,
+    migrate,
+)
+from src.pagination import Page
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE diagrams (id INTEGER PRIMARY KEY, title VARCHAR NOT NULL, "
+    "description VARCHAR NOT NULL, config VARCHAR, image VARCHAR, "
+    "project_id INTEGER NOT NULL, created_at DATETIME, updated_at DATETIME)",
+    "CREATE INDEX ix_diagrams_title ON diagrams (title)",
+    "CREATE INDEX ix_diagrams_description ON diagrams (description)",
+    "CREATE TABLE executeddiagramconfig (id INTEGER PRIMARY KEY, "
+    "diagram_id INTEGER NOT NULL, config VARCHAR NOT NULL, "
+    "created_at DATETIME, updated_at DATETIME)",
+    "INSERT INTO executeddiagramconfig (diagram_id, config) VALUES (1, '{}')",
+    "CREATE TABLE lastuseddiagram (id INTEGER PRIMARY KEY, "
+    "diagram_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+    "created_at DATETIME, updated_at DATETIME)",
+    "INSERT INTO lastuseddiagram (diagram_id, user_id, updated_at) VALUES "
+    "(1, 1, '2024-01-01'), (2, 1, '2024-01-02'), (1, 1, '2024-01-03'), "
+    "(1, 2, '2024-01-01')",
+]
+
+
+def sqlite_engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'migrate.db'}")
+
+
+def index_names(engine, table):
+    return {x["name"] for x in inspect(engine).get_indexes(table)}
+
+
+def test_migrate_fresh_database(tmp_path):
+    engine = sqlite_engine(tmp_path)
+    migrate(engine)
+    migrate(engine)
+
+    with engine.connect() as conn:
+        assert current_version(conn) == MIGRATIONS[-1][0]
+    assert "ix_diagrams_title" not in index_names(engine, "diagrams")
+    assert "ix_lastuseddiagram_user_id_updated_at" in index_names(
+        engine, "lastuseddiagram"
+    )
+
+
+def schema(engine):
+    inspector = inspect(engine)
+    return {
+        table: (
+            {
+                (x["name"], str(x["type"]), x["nullable"])
+                for x in inspector.get_columns(table)
+            },
+            {
+                (x["name"], tuple(x["column_names"]), bool(x["unique"]))
+                for x in inspector.get_indexes(table)
+            },
+        )
+        for table in inspector.get_table_names()
+        if table != "schema_version"
+    }
+
+
+def test_migrations_build_the_schema_of_the_models(tmp_path):
+    # a change to models.py without a migration fails here
+    migrated = sqlite_engine(tmp_path)
+    migrate(migrated)
+    expected = create_engine(f"sqlite:///{tmp_path / 'models.db'}")
+    SQLModel.metadata.create_all(expected)
+
+    assert schema(migrated) == schema(expected)
+
+
+def test_column_defaults_render_per_dialect():
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    project = baseline_metadata().tables["project"]
+    assert default_sql(project.c.owner_is_org, postgresql.dialect()) == "false"
+    assert default_sql(project.c.owner_is_org, sqlite.dialect()) == "0"
+    assert default_sql(project.c.status_code, postgresql.dialect()) == "1"
+
+
+def test_migrate_upgrades_legacy_database(tmp_path):
+    engine = sqlite_engine(tmp_path)
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(text(statement))
+
+    migrate(engine)
+
+    columns = {x["name"] for x in inspect(engine).get_columns("diagrams")}
+    assert {"image_hash", "thumbnail_key"} <= columns
+    assert index_names(engine, "diagrams") == {"ix_diagrams_project_id_updated_at"}
+    assert "ix_generatedcontent_diagram_id_config_id" in index_names(
+        engine, "generatedcontent"
+    )
+
+    with engine.connect() as conn:
+        recent = conn.execute(
+            text("SELECT user_id, diagram_id FROM lastuseddiagram ORDER BY id")
+        ).all()
+    assert recent == [(1, 2), (1, 1), (2, 1)]
+
+    # old rows stay readable with the defaults of the new columns
+    with Session(engine) as db:
+        row = crud.get_last_executed_config(db, 1)
+        assert row.encoding == "raw" and row.delta_depth == 0
+        assert crud.read_executed_config(db, row) == ("{}", None)
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    engine = sqlite_engine(tmp_path)
+    migrate(engine)
+    async_engine = create_async_engine(
+        async_database_url(f"sqlite:///{tmp_path / 'migrate.db'}")
+    )
+
+    with Session(engine) as db:
+        db.add(models.UserProject(user_id=1, project_id=1))
+        db.add(models.UserOrganization(user_id=1, organization_id=1))
+        db.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "DELETE")):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+
+    access_cache.clear()
+    page = Page(limit=10)
+    with Session(engine) as db:
+        permissions = load_permissions(db, 1)
+        crud.get_projects_by_user(db, 1, page=page)
+        crud.get_projects_by_organization(db, 1, permissions, page=page)
+        crud.get_diagrams_in_project(db, 1, permissions, page=page)
+        crud.get_last_executed_config(db, 1)
+        crud.create_executed_config(db, 1, "{}")
+        crud.get_generated_contents(db, 1, 1)
+        crud.touch_last_used_diagrams(db, {(1, 1): datetime.now()})
+
+    async def recent():
+        async with AsyncSession(async_engine) as db:
+            await crud.get_last_diagrams_async(db, 1)
+        await async_engine.dispose()
+
+    asyncio.run(recent())
+    assert len(statements) >= 10
+
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            ).all()
+            full_scans = [
+                x.detail
+                for x in plan
+                if x.detail.startswith("SCAN") and "USING" not in x.detail
+            ]
+            assert full_scans == [], statement
@@ -0,0 +1,44 @@
+import base64
+import io
+
+from PIL import Image
+
+from src.resize_canvas import make_thumbnail, resize_base64_image_preserve_aspect_ratio
+
+
+def png(width, height, mode="RGBA"):
+    buffered = io.BytesIO()
+    Image.new(mode, (width, height), "white").save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def test_make_thumbnail_formats():
+    for format in ["WEBP", "JPEG", "PNG"]:
+        thumbnail = make_thumbnail(png(3840, 2160), 300, format=format)
+        thumbnail = Image.open(io.BytesIO(thumbnail))
+        assert thumbnail.format == format
+        assert thumbnail.size == (300, 168)
+
+
+def test_make_thumbnail_palette_and_bitmap_images():
+    for mode in ["P", "1"]:
+        for format in ["WEBP", "JPEG", "PNG"]:
+            thumbnail = make_thumbnail(png(2400, 1200, mode), 300, format=format)
+            assert Image.open(io.BytesIO(thumbnail)).size == (300, 150)
+
+
+def test_make_thumbnail_accepts_bytes_base64_and_data_url():
+    raw = png(640, 480)
+    b64 = base64.b64encode(raw).decode("utf-8")
+    outputs = [
+        make_thumbnail(x, new_height=120, format="PNG")
+        for x in [raw, b64, "data:image/png;base64," + b64]
+    ]
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert Image.open(io.BytesIO(outputs[0])).size == (160, 120)
+
+
+def test_resize_base64_image_keeps_png_output():
+    b64 = base64.b64encode(png(1200, 600, "RGB")).decode("utf-8")
+    thumbnail = base64.b64decode(resize_base64_image_preserve_aspect_ratio(b64, 300))
+    assert Image.open(io.BytesIO(thumbnail)).format == "PNG"
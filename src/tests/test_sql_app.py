@@ -1,22 +1,42 @@
+import asyncio
+import base64
+import io
+import threading
+
 from fastapi.testclient import TestClient
+from PIL import Image
 
-from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.tests.initialize_data import init_status_code
 
+from .. import crud
+from ..authz import access_cache
+from ..connections import ws_queue_size
+from ..jobs import get_broker
 from ..main import app
-from ..util import get_db
+from ..models import LastUsedDiagram, User, UserProject
+from ..recent_diagrams import recent_diagrams
+from ..thumbnails import thumbnail_pipeline
+from ..database import async_database_url, configure_engine
+from ..util import PasswordPool, get_async_db, get_db
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_test.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+engine = configure_engine(
+    create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 )
+async_engine = create_async_engine(async_database_url(SQLALCHEMY_DATABASE_URL))
+configure_engine(async_engine.sync_engine)
 
 
 def init_db():
     SQLModel.metadata.drop_all(bind=engine)
     SQLModel.metadata.create_all(bind=engine)
+    access_cache.clear()
 
 
 def override_get_db():
@@ -27,7 +47,15 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
+        yield db
+
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+recent_diagrams.get_db = override_get_db
+get_broker().get_db = override_get_db
 
 client = TestClient(app)
 
@@ -137,9 +165,18 @@ def test_create_diagram_in_project():
     assert data["config"] == TEST_DIAGRAM["config"]
     assert data["project_id"] == 1
 
+    # a project the user can't access, named in the path only
+    response = client.post(
+        f"/project/{99}/diagram", json=TEST_DIAGRAM, headers=auth_header()
+    )
+    assert response.status_code == 400
+
 
 def test_get_diagrams_by_project():
     response = client.get(f"/project/{1}/diagram", headers=auth_header())
+    assert "config" not in response.json()[0]
+
+    response = client.get(f"/project/{1}/diagram?fields=config", headers=auth_header())
 
     data = response.json()
     print(data)
@@ -219,3 +256,223 @@ def test_get_org_projects():
     assert data[1]["name"] == TEST_PROJECT["name"]
     assert data[1]["description"] == TEST_PROJECT["description"]
     assert data[1]["status_code"] == 1
+
+
+def test_sqlite_pragmas():
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+
+def test_login_upgrades_password_hash(monkeypatch):
+    monkeypatch.setenv("BCRYPT_ROUNDS", "5")
+    get_token()
+
+    user = Session(engine).exec(select(User).where(User.id == TEST_USER["id"])).first()
+    assert user.password.startswith("$2b$05$")
+    get_token()
+
+
+def test_current_user_is_cached(monkeypatch):
+    headers = auth_header()
+    assert client.get("/users/me/", headers=headers).status_code == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError("user should come from the cache")
+
+    monkeypatch.setattr(crud, "get_user_username_async", fail)
+    monkeypatch.setattr(crud.jwt, "decode", fail)
+    response = client.get("/users/me/", headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["username"] == TEST_USER["username"]
+
+    with Session(engine) as db:
+        user = db.exec(select(User).where(User.id == TEST_USER["id"])).first()
+        user.is_active = False
+        db.add(user)
+        db.commit()
+
+    monkeypatch.undo()
+    response = client.get("/users/me/", headers=headers)
+    assert response.status_code == 400
+
+    with Session(engine) as db:
+        user = db.exec(select(User).where(User.id == TEST_USER["id"])).first()
+        user.is_active = True
+        db.add(user)
+        db.commit()
+
+
+def canvas_png(width=1200, height=600, color="white"):
+    buffered = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def test_update_diagram_builds_thumbnail_in_background(monkeypatch, tmp_path):
+    monkeypatch.setenv("BLOB_STORE_PATH", str(tmp_path))
+    monkeypatch.setattr(thumbnail_pipeline, "get_db", override_get_db)
+    processed = []
+    process = thumbnail_pipeline._process
+
+    def record(diagram_id, image, digest):
+        processed.append(digest)
+        process(diagram_id, image, digest)
+
+    monkeypatch.setattr(thumbnail_pipeline, "_process", record)
+
+    data = {"diagram_id": "1", "diagram_image": canvas_png(), "config": "new config"}
+    response = client.put("/diagram", json=data, headers=auth_header())
+    assert response.status_code == 200, response.text
+    assert response.json()["config"] == "new config"
+    assert thumbnail_pipeline.join(timeout=10)
+
+    diagram = client.get("/diagram/1", headers=auth_header()).json()
+    assert "image" not in diagram
+    response = client.get(diagram["thumbnail_url"], headers=auth_header())
+    assert response.status_code == 200, response.text
+    assert "immutable" in response.headers["cache-control"]
+    thumbnail = Image.open(io.BytesIO(response.content))
+    assert thumbnail.size == (300, 150)
+
+    headers = {"If-None-Match": response.headers["etag"], **auth_header()}
+    assert client.get(diagram["thumbnail_url"], headers=headers).status_code == 304
+
+    prefix = diagram["thumbnail_url"][: diagram["thumbnail_url"].index("=") + 2]
+    response = client.get(prefix, headers=auth_header())
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    listed = client.get("/recent/diagrams", headers=auth_header()).json()
+    assert listed[0]["thumbnail_url"] == diagram["thumbnail_url"]
+    assert "image" not in listed[0]
+
+    # same canvas again, nothing to do
+    client.put("/diagram", json=data, headers=auth_header())
+    assert thumbnail_pipeline.join(timeout=10)
+    assert len(processed) == 1
+
+
+def test_recent_diagrams_keep_one_row_per_diagram(monkeypatch):
+    monkeypatch.setenv("RECENT_DIAGRAMS_KEEP", "5")
+    for x in range(7):
+        client.post(
+            "/project/1/diagram",
+            json={**TEST_DIAGRAM, "title": f"diagram {x}"},
+            headers=auth_header(),
+        )
+    for _ in range(3):
+        assert client.get("/diagram/1", headers=auth_header()).status_code == 200
+    recent_diagrams.join(timeout=10)
+
+    with Session(engine) as db:
+        rows = db.exec(select(LastUsedDiagram)).all()
+    assert len(rows) == 5
+    assert len({x.diagram_id for x in rows}) == 5
+
+    listed = client.get("/recent/diagrams", headers=auth_header()).json()
+    assert listed[0]["id"] == 1
+    assert listed[1]["title"] == "diagram 6"
+
+
+def test_listing_rejects_unknown_fields():
+    response = client.get("/project?fields=password", headers=auth_header())
+    assert response.status_code == 400
+
+
+def test_org_projects_are_paginated():
+    response = client.get("/organization/1/project?limit=1", headers=auth_header())
+    assert response.status_code == 200, response.text
+    first = response.json()
+    assert len(first) == 1
+    cursor = response.headers["x-next-cursor"]
+    assert 'rel="next"' in response.headers["link"]
+
+    response = client.get(
+        f"/organization/1/project?limit=1&cursor={cursor}", headers=auth_header()
+    )
+    second = response.json()
+    assert len(second) == 1
+    assert second[0]["id"] != first[0]["id"]
+    assert "x-next-cursor" not in response.headers
+
+    response = client.get("/project?cursor=not-a-cursor", headers=auth_header())
+    assert response.status_code == 400
+
+
+def test_permissions_are_cached_and_evicted():
+    other = {"email": "wade@example.com", "password": "x", "username": "wade"}
+    user_id = client.post("/users/", json=other).json()["id"]
+    token = client.post(
+        "/token", data={"username": other["email"], "password": other["password"]}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/diagram/1", headers=headers).status_code == 400
+    assert client.get("/project/1/diagram", headers=headers).status_code == 400
+    assert client.get("/organization/1", headers=headers).status_code == 400
+
+    with Session(engine) as db:
+        db.add(UserProject(user_id=user_id, project_id=1))
+        db.commit()
+    assert client.get("/diagram/1", headers=headers).status_code == 200
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        assert client.get("/diagram/1", headers=headers).status_code == 200
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+    # user and permissions come from their caches, only the diagram is read
+    assert len(statements) == 1
+
+    with Session(engine) as db:
+        db.delete(db.get(UserProject, (user_id, 1)))
+        db.commit()
+    assert client.get("/diagram/1", headers=headers).status_code == 400
+
+
+def test_responses_carry_server_timing():
+    response = client.get("/diagram/1", headers=auth_header())
+    assert response.status_code == 200, response.text
+    phases = {
+        x.split(";")[0].strip() for x in response.headers["server-timing"].split(",")
+    }
+    assert {"auth", "db", "serialize", "handler", "total"} <= phases
+    assert float(response.headers["x-process-time"]) > 0
+
+
+def test_metrics():
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers=auth_header())
+    assert response.status_code == 200, response.text
+    assert response.json()["password_pool"]["completed"] > 0
+    assert response.json()["connections"] == []
+
+    with client.websocket_connect("/ws", headers=auth_header()):
+        connections = client.get("/metrics", headers=auth_header()).json()[
+            "connections"
+        ]
+    assert [x["max_queue"] for x in connections] == [ws_queue_size()]
+
+
+def test_password_pool_forgets_jobs_given_up_in_the_queue():
+    pool = PasswordPool(max_workers=1)
+    gate = threading.Event()
+
+    async def run():
+        first = asyncio.create_task(pool.run(gate.wait))
+        second = asyncio.create_task(pool.run(gate.wait))
+        await asyncio.sleep(0.05)
+        second.cancel()
+        await asyncio.sleep(0.05)
+        gate.set()
+        await first
+
+    asyncio.run(run())
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"], stats["completed"]) == (0, 0, 1)
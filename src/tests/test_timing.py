@@ -0,0 +1,54 @@
+import asyncio
+
+from src.timing import TimingMiddleware, phase
+
+
+def run_asgi(app, body_chunks):
+    sent = []
+    received = []
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": x < len(body_chunks) - 1}
+        for x, chunk in enumerate(body_chunks)
+    ]
+
+    async def receive():
+        message = messages.pop(0)
+        received.append(message)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "PUT",
+        "path": "/diagram",
+        "headers": [(b"content-length", b"6")],
+    }
+    asyncio.run(app(scope, receive, send))
+    return sent, received
+
+
+def test_timing_middleware_leaves_body_to_the_app():
+    seen = []
+
+    async def app(scope, receive, send):
+        # the app must get the first chunk, nothing was read ahead of it
+        first = await receive()
+        seen.append(first["body"])
+        with phase("auth"):
+            pass
+        while first["more_body"]:
+            first = await receive()
+            seen.append(first["body"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sent, received = run_asgi(TimingMiddleware(app, sample_rate=1), [b"abc", b"def"])
+
+    assert seen == [b"abc", b"def"]
+    assert len(received) == 2
+    headers = dict(sent[0]["headers"])
+    assert b"auth;dur=" in headers[b"server-timing"]
+    assert b"total;dur=" in headers[b"server-timing"]
+    assert b"x-process-time" in headers
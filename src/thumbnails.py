@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Set, Tuple, Union
+
+from .blob_store import get_blob_store
+from .crud import update_diagram_thumbnail
+from .resize_canvas import make_thumbnail
+from .util import get_db
+
+logger = logging.getLogger(__name__)
+
+
+def image_digest(image: str) -> str:
+    return hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+
+class ThumbnailPipeline:
+    # builds diagram thumbnails off the request path
+    # - a save whose canvas hashes the same as the last one is skipped
+    # - at most one job per diagram runs at a time; saves arriving meanwhile
+    #   replace each other, so only the newest canvas gets processed
+
+    def __init__(
+        self, get_db: Callable = get_db, max_workers: int = None, width: int = 300
+    ):
+        self.get_db = get_db
+        self.width = width
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("THUMBNAIL_WORKERS", "2")),
+            thread_name_prefix="thumbnail",
+        )
+        self.condition = threading.Condition()
+        self.pending: Dict[int, Tuple[str, str]] = {}
+        self.active: Set[int] = set()
+        self.latest: Dict[int, str] = {}
+
+    def submit(
+        self, diagram_id: int, image: str, stored_hash: Union[str, None] = None
+    ) -> bool:
+        digest = image_digest(image)
+        with self.condition:
+            if digest == self.latest.get(diagram_id, stored_hash):
+                return False
+            self.latest[diagram_id] = digest
+            self.pending[diagram_id] = (image, digest)
+            if diagram_id not in self.active:
+                self.active.add(diagram_id)
+                self.executor.submit(self._work, diagram_id)
+        return True
+
+    def _work(self, diagram_id: int):
+        while True:
+            with self.condition:
+                item = self.pending.pop(diagram_id, None)
+                if item is None:
+                    self.active.discard(diagram_id)
+                    self.condition.notify_all()
+                    return
+            image, digest = item
+            try:
+                self._process(diagram_id, image, digest)
+            except Exception:
+                logger.exception(f"Could not build thumbnail of diagram {diagram_id}")
+                with self.condition:
+                    # let the next save of the same canvas try again
+                    if self.latest.get(diagram_id) == digest:
+                        del self.latest[diagram_id]
+
+    def _process(self, diagram_id: int, image: str, digest: str):
+        thumbnail = make_thumbnail(image, self.width)
+        key = get_blob_store().put(thumbnail)
+        db_gen = self.get_db()
+        db = next(db_gen)
+        try:
+            update_diagram_thumbnail(db, diagram_id, key, digest)
+        finally:
+            db_gen.close()
+
+    def join(self, timeout: float = None) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.active, timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+thumbnail_pipeline = ThumbnailPipeline()
@@ -0,0 +1,109 @@
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Union
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import Headers, MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+# phase name -> seconds spent, for the request being served
+# threadpool workers get a copy of the context, the dict itself is shared
+request_timings: ContextVar[Union[dict, None]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def add_timing(name: str, seconds: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("timing_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    starts = conn.info.get("timing_start")
+    if starts:
+        add_timing("db", time.perf_counter() - starts.pop())
+
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with phase("serialize"):
+            return super().render(content)
+
+
+def server_timing(timings: dict, total: float) -> str:
+    # db overlaps auth and handler, handler is what is left of the total
+    # after auth and serialization
+    handler = total - timings.get("auth", 0.0) - timings.get("serialize", 0.0)
+    phases = {**timings, "handler": max(handler, 0.0), "total": total}
+    return ", ".join(f"{name};dur={x * 1000:.2f}" for name, x in phases.items())
+
+
+def timing_sample_rate():
+    return float(os.getenv("TIMING_SAMPLE_RATE", "0"))
+
+
+class TimingMiddleware:
+    # pure ASGI, the request body is streamed to the app untouched
+    # - Server-Timing: auth, db, serialize, handler and total in ms
+    # - X-Process-Time: seconds until the response started
+    # - a sample of requests is logged together with their Content-Length
+
+    def __init__(self, app, sample_rate: float = None):
+        self.app = app
+        self.sample_rate = (
+            sample_rate if sample_rate is not None else timing_sample_rate()
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        response = {}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - start
+                response["status"] = message["status"]
+                response["timing"] = server_timing(timings, total)
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", response["timing"])
+                headers.append("X-Process-Time", str(total))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            if self.sample_rate and random.random() < self.sample_rate:
+                length = Headers(scope=scope).get("content-length", "-")
+                logger.info(
+                    f"{scope['method']} {scope['path']} {response.get('status')} "
+                    f"body={length} {response.get('timing')}"
+                )
@@ -1,7 +1,14 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from fastapi.security import OAuth2PasswordBearer
 import bcrypt
 from sqlmodel import Session
-from .database import engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .database import async_engine, engine
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -14,6 +21,24 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    # no lazy loading is possible on an async session, so keep loaded
+    # attributes around after commit
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
+        yield db
+
+
+def requested_fields(fields: str | None = None) -> list[str]:
+    # ?fields=config,created_at - extra columns for listing endpoints
+    if not fields:
+        return []
+    return [x.strip() for x in fields.split(",") if x.strip()]
+
+
+def bcrypt_rounds():
+    return int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+
 def verify_password(plain_password, hashed_password):
     return bcrypt.checkpw(
         plain_password.encode("utf-8"), hashed_password.encode("utf-8")
@@ -23,6 +48,79 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     if password is None:
         return ""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=bcrypt_rounds())
     pw = bcrypt.hashpw(password.encode("utf-8"), salt)
     return pw.decode("utf-8")
+
+
+def password_needs_rehash(hashed_password):
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed_password.split("$")[2]) != bcrypt_rounds()
+    except (IndexError, ValueError):
+        return True
+
+
+class PasswordPool:
+    # bcrypt releases the GIL, so a few threads keep hashing off the event loop
+    # without letting a login storm take every core
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or int(os.getenv("BCRYPT_WORKERS", "2"))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="bcrypt"
+        )
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _job(self, submitted_at, fn, args):
+        waited = time.perf_counter() - submitted_at
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    def _dropped(self, job: Future):
+        # the caller gave up while the job was still queued, _job never ran
+        if job.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    async def run(self, fn, *args):
+        with self.lock:
+            self.queued += 1
+        job = self.executor.submit(self._job, time.perf_counter(), fn, args)
+        job.add_done_callback(self._dropped)
+        return await asyncio.wrap_future(job)
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+password_pool = PasswordPool()
+
+
+async def verify_password_async(plain_password, hashed_password):
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    return await password_pool.run(get_password_hash, password)
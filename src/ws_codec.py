@@ -0,0 +1,62 @@
+import json
+from typing import Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# websocket framing, picked per connection from the subprotocols the client
+# offers (Sec-WebSocket-Protocol), best first:
+#   diag.msgpack - binary frames, msgpack maps (needs the msgpack package)
+#   diag.json    - text frames, json
+# clients offering nothing get json text frames, as before
+
+
+class JSONCodec:
+    name = "diag.json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        if orjson is not None:
+            return orjson.dumps(message).decode("utf-8")
+        return json.dumps(message)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "diag.msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if isinstance(data, str):
+            # control messages from the client may still come as json text
+            return JSONCodec().decode(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+def available_codecs():
+    codecs = [JSONCodec()]
+    if msgpack is not None:
+        codecs.insert(0, MsgpackCodec())
+    return codecs
+
+
+def negotiate(offered: list[str]):
+    # (codec, subprotocol to accept with or None)
+    for codec in available_codecs():
+        if codec.name in offered:
+            return codec, codec.name
+    return JSONCodec(), None